@@ -0,0 +1,155 @@
+"""
+Benchmark the patch codecs (see data_utils.get_patch_codec()), for each codec this measures the bytes on disk, the
+decode throughput per data loader worker and the IoU impact on a held-out set
+The IoU is measured by round-tripping the held-out tiles through the codec and evaluating the model on the decoded
+tiles, this is how a model trained and evaluated on such patches would see the imagery
+"""
+
+
+# Built-in
+import os
+import time
+import shutil
+import tempfile
+from multiprocessing import Pool
+
+# Libs
+import numpy as np
+import albumentations as A
+from albumentations.pytorch import ToTensorV2
+
+# Own modules
+from data import data_utils
+from mrs_utils import misc_utils, eval_utils
+from network import network_io, network_utils
+
+# Settings
+GPU = 0
+MODEL_DIR = r'/home/wh145/models/ecvgg16_dcunet_dsmnih_lre1e-03_lrd1e-02_ep80_bs5_ds50_dr0p1'
+LOAD_EPOCH = 80
+DATA_DIR = r'/home/wh145/mnih'
+DS_NAME = 'mnih'
+PATCH_SIZE = (512, 512)
+CODECS = [('npy', None), ('png', None), ('jpg', 95), ('jpg', 75), ('webp', 90), ('webp', 100)]
+N_TILES = 5
+N_PATCHES = 500
+N_WORKERS = (1, 4)
+BATCH_SIZE = 8
+
+
+def encode_patches(rgb_files, save_dir, codec, quality, patch_size, n_patches):
+    """
+    Cut patches from the tiles and save them with the given codec
+    :param rgb_files: list of rgb tiles
+    :param save_dir: directory to save the patches
+    :param codec: format of the image patches
+    :param quality: quality of the lossy formats
+    :param patch_size: size of the patches
+    :param n_patches: max #patches to save
+    :return: list of the saved patch files
+    """
+    codec_info = data_utils.get_patch_codec(codec, quality)
+    patch_files = []
+    for rgb_file in rgb_files:
+        rgb = misc_utils.load_file(rgb_file)[:, :, :3]
+        prefix = os.path.splitext(os.path.basename(rgb_file))[0]
+        for y, x in data_utils.make_grid(rgb.shape[:2], patch_size, 0):
+            patch_file = os.path.join(save_dir, '{}_y{}x{}.{}'.format(prefix, int(y), int(x), codec_info['img_ext']))
+            misc_utils.save_file(patch_file, data_utils.crop_image(rgb, y, x, *patch_size),
+                                 **codec_info['img_kwargs'])
+            patch_files.append(patch_file)
+            if len(patch_files) >= n_patches:
+                return patch_files
+    return patch_files
+
+
+def _decode_files(files):
+    start_time = time.time()
+    for f in files:
+        misc_utils.load_file(f)
+    return len(files), time.time() - start_time
+
+
+def measure_decode(patch_files, n_workers):
+    """
+    Decode the patches with n_workers processes, each process decodes its own share of the patches
+    :param patch_files: list of the patch files
+    :param n_workers: #processes
+    :return: decoded patches per second per worker and in total
+    """
+    shares = [patch_files[a::n_workers] for a in range(n_workers)]
+    start_time = time.time()
+    with Pool(n_workers) as pool:
+        results = pool.map(_decode_files, shares)
+    duration = time.time() - start_time
+    per_worker = np.mean([n / t for n, t in results if t > 0])
+    return per_worker, len(patch_files) / duration
+
+
+def measure_iou(base_evaluator, model, rgb_files, lbl_files, save_dir, codec, quality, patch_size):
+    """
+    Round-trip the tiles through the codec and evaluate the model on them
+    :param base_evaluator: evaluator of the held-out set, its label settings are reused
+    :param model: the model to evaluate
+    :param rgb_files: list of rgb tiles
+    :param lbl_files: list of label tiles
+    :param save_dir: directory to save the encoded tiles
+    :param codec: format of the image patches
+    :param quality: quality of the lossy formats
+    :param patch_size: size of the patches
+    :return: the overall IoU
+    """
+    codec_info = data_utils.get_patch_codec(codec, quality)
+    coded_files = []
+    for rgb_file in rgb_files:
+        coded_file = os.path.join(save_dir, '{}.{}'.format(os.path.splitext(os.path.basename(rgb_file))[0],
+                                                           codec_info['img_ext']))
+        misc_utils.save_file(coded_file, misc_utils.load_file(rgb_file)[:, :, :3], **codec_info['img_kwargs'])
+        coded_files.append(coded_file)
+    evaluator = eval_utils.Evaluator('codec_benchmark', save_dir, base_evaluator.tsfm, base_evaluator.device,
+                                     load_func=lambda data_dir: (coded_files, lbl_files),
+                                     batch_size=base_evaluator.batch_size, truth_val=base_evaluator.truth_val,
+                                     decode_func=base_evaluator.decode_func, encode_func=base_evaluator.encode_func,
+                                     class_names=base_evaluator.class_names)
+    return evaluator.evaluate(model, patch_size, 2 * model.lbl_margin, verbose=False)
+
+
+def main():
+    device, _ = misc_utils.set_gpu(GPU)
+
+    # init model
+    args = network_io.load_config(MODEL_DIR)
+    model = network_io.create_model(args)
+    if LOAD_EPOCH:
+        args['trainer']['epochs'] = LOAD_EPOCH
+    network_utils.load(model, os.path.join(MODEL_DIR, 'epoch-{}.pth.tar'.format(args['trainer']['epochs'])))
+    model.to(device)
+    model.eval()
+    tsfm_valid = A.Compose([A.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)), ToTensorV2()])
+    base_evaluator = eval_utils.Evaluator(DS_NAME, DATA_DIR, tsfm_valid, device, batch_size=BATCH_SIZE)
+    rgb_files, lbl_files = base_evaluator.rgb_files[:N_TILES], base_evaluator.lbl_files[:N_TILES]
+
+    results = []
+    for codec, quality in CODECS:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            patch_files = encode_patches(rgb_files, tmp_dir, codec, quality, PATCH_SIZE, N_PATCHES)
+            n_bytes = np.mean([os.path.getsize(f) for f in patch_files])
+            decode = [measure_decode(patch_files, n) for n in N_WORKERS]
+            iou = measure_iou(base_evaluator, model, rgb_files, lbl_files, tmp_dir, codec, quality, PATCH_SIZE)
+        finally:
+            shutil.rmtree(tmp_dir)
+        results.append((codec, quality, n_bytes, decode, iou))
+
+    print('{:<6}{:>8}{:>12}'.format('codec', 'quality', 'KB/patch') +
+          ''.join(['{:>14}{:>14}'.format('{}w:/worker'.format(n), '{}w:total'.format(n)) for n in N_WORKERS]) +
+          '{:>8}{:>8}'.format('IoU', 'delta'))
+    ref_iou = results[0][-1]
+    for codec, quality, n_bytes, decode, iou in results:
+        print('{:<6}{:>8}{:>12.1f}'.format(codec, str(quality), n_bytes / 1024) +
+              ''.join(['{:>14.1f}{:>14.1f}'.format(*a) for a in decode]) +
+              '{:>8.2f}{:>+8.2f}'.format(iou, iou - ref_iou))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ This file defines data loader for some benchmarked remote sensing datasets
 
 # Built-in
 import os
+from collections import OrderedDict
 
 # Libs
 import torch
@@ -14,6 +15,7 @@ from torch.utils import data
 
 # Own modules
 from mrs_utils import misc_utils
+from data import tile_reader, patch_extractor, fg_index, patch_cache
 
 
 def get_file_paths(parent_path, file_list, with_label=True):
@@ -46,8 +48,34 @@ def one_hot(class_n, x):
     return torch.eye(class_n)[x]
 
 
+def apply_transforms(output_dict, transforms=None, n_class=2, with_aux=False):
+    """
+    Apply the albumentation transforms to a sample and make its auxiliary classification label, this is shared by the
+    data readers
+    :param output_dict: dictionary of the sample, image and optionally mask
+    :param transforms: albumentation transforms
+    :param n_class: number of classes, used to make the auxiliary classification label
+    :param with_aux: if True, auxiliary classification label will be added as cls
+    :return: the transformed sample
+    """
+    if transforms:
+        for tsfm in transforms:
+            tsfm_image = tsfm(**output_dict)
+            for key, val in tsfm_image.items():
+                output_dict[key] = val
+    if with_aux:
+        if len(output_dict['mask'].shape) == 2:
+            cls = int(torch.mean(output_dict['mask'].type(torch.float)) > 0)
+            cls = one_hot(n_class, cls).type(torch.float)
+        else:
+            cls = (torch.sum(output_dict['mask'], dim=-1) > 0).type(torch.float)
+        output_dict['cls'] = cls
+    return output_dict
+
+
 class RSDataLoader(data.Dataset):
-    def __init__(self, parent_path, file_list, transforms=None, n_class=2, with_label=True, with_aux=False):
+    def __init__(self, parent_path, file_list, transforms=None, n_class=2, with_label=True, with_aux=False,
+                 cache_bytes=0, cache_dir=None):
         """
         A data reader for the remote sensing dataset
         The dataset storage structure should be like
@@ -63,6 +91,9 @@ class RSDataLoader(data.Dataset):
         :param n_class: if greater than 0, will yield a #classes dimension vector where 1 indicates corresponding class exist
         :param with_label: if True, label files will be read, otherwise label files will be ignored
         :param with_aux: if True, auxiliary classification label will be returned
+        :param cache_bytes: if greater than 0, the decoded patches are kept in a patch_cache.PatchCache of this many
+                            bytes shared by all the workers, so they are only decoded once
+        :param cache_dir: directory of the cache files, if None, shared memory (/dev/shm) is used
         """
         self.with_label = with_label
         try:
@@ -79,28 +110,35 @@ class RSDataLoader(data.Dataset):
         self.transforms = transforms
         self.n_class = n_class
         self.with_aux = with_aux
+        self.cache = None
+        if cache_bytes > 0 and len(self.img_list) > 0:
+            # the slots are sized by the first patch, patches of other sizes are not cached
+            arrays = self.load_patch(0)
+            self.cache = patch_cache.PatchCache(len(self.img_list), [a.shape for a in arrays],
+                                                [a.dtype for a in arrays], cache_bytes, cache_dir)
 
     def __len__(self):
         return len(self.img_list)
 
+    def load_patch(self, index):
+        arrays = [misc_utils.load_file(self.img_list[index])]
+        if self.with_label:
+            arrays.append(misc_utils.load_file(self.lbl_list[index]))
+        return arrays
+
     def __getitem__(self, index):
+        arrays = None
+        if self.cache is not None:
+            arrays = self.cache.get(index)
+        if arrays is None:
+            arrays = self.load_patch(index)
+            if self.cache is not None:
+                self.cache.put(index, arrays)
         output_dict = dict()
-        output_dict['image'] = misc_utils.load_file(self.img_list[index])
+        output_dict['image'] = arrays[0]
         if self.with_label:
-            output_dict['mask'] = misc_utils.load_file(self.lbl_list[index])
-        if self.transforms:
-            for tsfm in self.transforms:
-                tsfm_image = tsfm(**output_dict)
-                for key, val in tsfm_image.items():
-                    output_dict[key] = val
-        if self.with_aux:
-            if len(output_dict['mask'].shape) == 2:
-                cls = int(torch.mean(output_dict['mask'].type(torch.float)) > 0)
-                cls = one_hot(self.n_class, cls).type(torch.float)
-            else:
-                cls = (torch.sum(output_dict['mask'], dim=-1) > 0).type(torch.float)
-            output_dict['cls'] = cls
-        return output_dict
+            output_dict['mask'] = arrays[1]
+        return apply_transforms(output_dict, self.transforms, self.n_class, self.with_aux)
 
 
 def infi_loop_loader(dl):
@@ -155,22 +193,357 @@ class HDF5DataLoader(data.Dataset):
             return rgb, lbl
 
 
-def get_loader(data_path, file_name, transforms=None, n_class=2, with_aux=False):
+class HDF5BatchDataLoader(data.Dataset):
+    def __init__(self, parent_path, file_list, transforms=None, n_class=2, with_aux=False):
+        """
+        A batch-level data reader for the remote sensing dataset in hdf5 format, e.g. the stores of
+        data_utils.pack_tiles(), each item is a whole batch read with one fancy-index read per dataset
+        It should be used with ChunkShuffleBatchSampler and batch_size=None in the DataLoader, the indices of each batch
+        are read in sorted order, the transforms are applied to each sample afterwards
+        :param parent_path: path to a preprocessed remote sensing dataset
+        :param file_list: name of the hdf5 file, it should have the img and lbl datasets
+        :param transforms: albumentation transforms
+        :param n_class: number of classes, used to make the auxiliary classification label
+        :param with_aux: if True, auxiliary classification label will be returned
+        """
+        self.file_path = os.path.join(parent_path, file_list)
+        self.transforms = transforms
+        self.dataset = None
+        self.n_class = n_class
+        self.with_aux = with_aux
+        with h5py.File(self.file_path, 'r') as file:
+            self.dataset_len = file['img'].shape[0]
+            self.chunk_size = file['img'].chunks[0] if file['img'].chunks else 64
+
+    def __len__(self):
+        return self.dataset_len
+
+    def __getitem__(self, indices):
+        if self.dataset is None:
+            self.dataset = h5py.File(self.file_path, 'r')
+        # h5py reads fancy indices in increasing order only, the batch is put back in the sampled order afterwards
+        indices, inverse = np.unique(np.array(indices), return_inverse=True)
+        rgbs = self.dataset['img'][indices, ...][inverse]
+        lbls = self.dataset['lbl'][indices, ...][inverse]
+        batch = []
+        for rgb, lbl in zip(rgbs, lbls):
+            output_dict = {'image': rgb, 'mask': lbl}
+            batch.append(apply_transforms(output_dict, self.transforms, self.n_class, self.with_aux))
+        return data.dataloader.default_collate(batch)
+
+
+class ChunkShuffleBatchSampler(data.sampler.Sampler):
+    def __init__(self, ds_len, batch_size, chunk_size, mix_chunks=4, shuffle=True, drop_last=True):
+        """
+        Batch sampler that shuffles at the granularity of the hdf5 chunks, the order of the chunks is shuffled and the
+        samples are shuffled within every mix_chunks consecutive chunks, so each batch only touches a few chunks
+        :param ds_len: length of the dataset
+        :param batch_size: #samples in each batch
+        :param chunk_size: #samples in each chunk of the dataset
+        :param mix_chunks: #chunks whose samples are mixed together, larger values give more random batches
+        :param shuffle: if False, the batches are in the order of the dataset
+        :param drop_last: if True, the last incomplete batch is dropped
+        """
+        super(ChunkShuffleBatchSampler, self).__init__(None)
+        self.ds_len = ds_len
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.mix_chunks = mix_chunks
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return self.ds_len // self.batch_size
+        return int(np.ceil(self.ds_len / self.batch_size))
+
+    def __iter__(self):
+        if self.shuffle:
+            n_chunk = int(np.ceil(self.ds_len / self.chunk_size))
+            chunk_idx = np.random.permutation(n_chunk)
+            order = []
+            for group_start in range(0, n_chunk, self.mix_chunks):
+                group = np.concatenate([np.arange(c * self.chunk_size, min((c + 1) * self.chunk_size, self.ds_len))
+                                        for c in chunk_idx[group_start:group_start + self.mix_chunks]])
+                order.append(np.random.permutation(group))
+            order = np.concatenate(order)
+        else:
+            order = np.arange(self.ds_len)
+        for cnt in range(len(self)):
+            yield order[cnt * self.batch_size:(cnt + 1) * self.batch_size].tolist()
+
+
+def decode_member(name, raw):
+    """
+    Decode a patch stored in a tar shard
+    :param name: name of the member, the extension decides how it is decoded
+    :param raw: the bytes of the member
+    :return: the decoded patch
+    """
+    from io import BytesIO
+    if name[-3:] == 'npy':
+        return np.load(BytesIO(raw))
+    from PIL import Image
+    return np.array(Image.open(BytesIO(raw)))
+
+
+def iter_shard(shard_file):
+    """
+    Stream the samples of a tar shard made by data_utils.write_shards(), the shard is read sequentially
+    :param shard_file: path to the shard
+    :return: generator of (image, label)
+    """
+    import tarfile
+    sample = {}
+    with tarfile.open(shard_file, mode='r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, field = member.name.split('.')[:2]
+            if sample and sample['key'] != key:
+                sample = {}
+            sample['key'] = key
+            sample[field] = decode_member(member.name, tar.extractfile(member).read())
+            if 'img' in sample and 'lbl' in sample:
+                yield sample['img'], sample['lbl']
+                sample = {}
+
+
+class ShardDataLoader(data.IterableDataset):
+    def __init__(self, parent_path, shard_list, transforms=None, n_class=2, with_aux=False, shuffle=True,
+                 buffer_size=1000, random_seed=1):
+        """
+        A streaming data reader of the tar shards made by data_utils.write_shards(), the shards are read sequentially
+        instead of opening every patch file, this is much faster on network file systems
+        The order of the shards is shuffled every epoch (call set_epoch() before each epoch) and the samples go through
+        a shuffle buffer, the shards are split across the nodes (torch.distributed) and then the DataLoader workers, so
+        every sample is read once per epoch
+        :param parent_path: directory of the shard list, used if shard_list is not an absolute path
+        :param shard_list: the json file that lists the shards
+        :param transforms: albumentation transforms
+        :param n_class: number of classes, used to make the auxiliary classification label
+        :param with_aux: if True, auxiliary classification label will be returned
+        :param shuffle: if False, the shards and samples are read in order, this should be False for validation
+        :param buffer_size: #samples in the shuffle buffer
+        :param random_seed: random seed of the shard order, it should be the same on all the nodes
+        """
+        super(ShardDataLoader, self).__init__()
+        shard_list = os.path.join(parent_path, shard_list)
+        shard_info = misc_utils.load_file(shard_list)
+        self.shard_files = [os.path.join(os.path.dirname(shard_list), a) for a in shard_info['shards']]
+        self.shard_counts = [int(a) for a in shard_info['counts']]
+        self.n_samples = int(np.sum(self.shard_counts))
+        self.transforms = transforms
+        self.n_class = n_class
+        self.with_aux = with_aux
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.random_seed = random_seed
+        self.epoch = 0
+        self.batch_size = None
+        self.num_workers = 0
+        self.drop_last = False
+
+    @staticmethod
+    def get_rank():
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_batching(self, batch_size, num_workers=0, drop_last=False):
+        """
+        Tell the dataset how the DataLoader batches it, so __len__() can account for the per worker split
+        :param batch_size: batch size of the DataLoader
+        :param num_workers: #workers of the DataLoader
+        :param drop_last: if True, every worker drops its own last incomplete batch
+        :return:
+        """
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.drop_last = drop_last
+
+    def __len__(self):
+        """
+        Without set_batching(), this is the #samples on this node. Otherwise every worker makes its own batches from its
+        shards of this epoch, the returned #samples is chosen so that len() of the DataLoader equals the #batches the
+        workers yield together
+        """
+        if not self.batch_size:
+            return self.n_samples // self.get_rank()[1]
+        n_batches = 0
+        for worker_id in range(max(self.num_workers, 1)):
+            n = sum([self.shard_counts[a] for a in self.get_shard_ids(worker_id, max(self.num_workers, 1))])
+            if self.drop_last:
+                n_batches += n // self.batch_size
+            else:
+                n_batches += int(np.ceil(n / self.batch_size))
+        if self.drop_last:
+            return n_batches * self.batch_size
+        return max((n_batches - 1) * self.batch_size + 1, 0)
+
+    def get_shard_ids(self, worker_id=0, num_workers=1):
+        order = np.arange(len(self.shard_files))
+        if self.shuffle:
+            # the same permutation on every node, so the shards of the nodes don't overlap
+            order = np.random.RandomState(self.random_seed + self.epoch).permutation(order)
+        rank, world_size = self.get_rank()
+        order = order[rank::world_size]
+        return order[worker_id::num_workers]
+
+    def get_shards(self):
+        worker_info = data.get_worker_info()
+        if worker_info is None:
+            order = self.get_shard_ids()
+        else:
+            order = self.get_shard_ids(worker_info.id, worker_info.num_workers)
+        return [self.shard_files[a] for a in order]
+
+    def make_sample(self, rgb, lbl):
+        output_dict = {'image': rgb, 'mask': lbl}
+        return apply_transforms(output_dict, self.transforms, self.n_class, self.with_aux)
+
+    def __iter__(self):
+        rng = np.random.RandomState(torch.initial_seed() % (2 ** 32))
+        buffer = []
+        for shard_file in self.get_shards():
+            for sample in iter_shard(shard_file):
+                if not self.shuffle:
+                    yield self.make_sample(*sample)
+                    continue
+                if len(buffer) < self.buffer_size:
+                    buffer.append(sample)
+                    continue
+                idx = rng.randint(len(buffer))
+                sample, buffer[idx] = buffer[idx], sample
+                yield self.make_sample(*sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self.make_sample(*sample)
+
+
+class TileDataLoader(data.Dataset):
+    def __init__(self, parent_path, file_list, patch_size, transforms=None, n_class=2, with_aux=False,
+                 samples_per_tile=None, pad=0, random_sample=True, truth_val=1, decode_func=None, max_readers=4):
+        """
+        A data reader that samples patches on the fly from the source tiles, so the tiles do not need to be cut into
+        patches beforehand. The tiles are opened with tile_reader.open_tile(), i.e., memory mapped or read window by
+        window when possible, pixels outside the tiles are filled by reflect padding
+        :param parent_path: path to the directory of the tiles
+        :param file_list: a text file where each row contains rgb and gt tiles separated by space
+        :param patch_size: size of the patches to sample, should be a tuple of (h, w)
+        :param transforms: albumentation transforms
+        :param n_class: if greater than 0, will yield a #classes dimension vector where 1 indicates corresponding class exist
+        :param with_aux: if True, auxiliary classification label will be returned
+        :param samples_per_tile: #patches sampled from each tile in one epoch, if None, it will be #patches to cover the
+                                 tile without overlap
+        :param pad: #pixels of reflect padding around the tiles, patches could reach into the padded area
+        :param random_sample: if True, patches are sampled at random locations, otherwise patches are read at fixed
+                              grid locations, which is useful for validation
+        :param truth_val: value of the positive class in the label tiles, labels are divided by it
+        :param decode_func: function to decode the label tiles, e.g. color coded labels into class ids
+        :param max_readers: max #tiles kept open in each worker, the least recently used tile is closed beyond this,
+                            tiles that can't be read by windows (e.g. jpg or png) are decoded as a whole, so this bounds
+                            the memory of each worker
+        """
+        try:
+            file_list = misc_utils.load_file(file_list)
+        except OSError:
+            file_list = misc_utils.load_file(os.path.join(parent_path, file_list))
+        self.img_list, self.lbl_list = get_file_paths(parent_path, file_list)
+        self.patch_size = patch_size
+        self.transforms = transforms
+        self.n_class = n_class
+        self.with_aux = with_aux
+        self.pad = pad
+        self.random_sample = random_sample
+        self.truth_val = truth_val
+        self.decode_func = decode_func
+        self.max_readers = max_readers
+        self.readers = OrderedDict()
+
+        # the readers are opened lazily in each worker, only the tile shapes are read from the headers here
+        self.tile_dims = [tile_reader.get_tile_dim(img_file) for img_file in self.img_list]
+        if self.random_sample:
+            if samples_per_tile is None:
+                samples_per_tile = [int(np.ceil((h + 2 * pad) / patch_size[0]) * np.ceil((w + 2 * pad) / patch_size[1]))
+                                    for h, w in self.tile_dims]
+            else:
+                samples_per_tile = [samples_per_tile for _ in self.tile_dims]
+            self.index = [(tile_cnt, None) for tile_cnt, n in enumerate(samples_per_tile) for _ in range(n)]
+        else:
+            self.index = [(tile_cnt, grid) for tile_cnt, (h, w) in enumerate(self.tile_dims)
+                          for grid in patch_extractor.make_grid((h + 2 * pad, w + 2 * pad), patch_size, 0)]
+
+    def get_reader(self, tile_cnt):
+        """
+        Get the readers of the rgb and gt tiles, the readers are opened in the worker process that uses them and at most
+        max_readers tiles are kept open
+        :param tile_cnt: index of the tile
+        :return: the rgb and gt readers
+        """
+        if tile_cnt in self.readers:
+            self.readers.move_to_end(tile_cnt)
+            return self.readers[tile_cnt]
+        while len(self.readers) >= max(self.max_readers, 1):
+            for reader in self.readers.popitem(last=False)[1]:
+                reader.close()
+        self.readers[tile_cnt] = (tile_reader.open_tile(self.img_list[tile_cnt], channels=3),
+                                  tile_reader.open_tile(self.lbl_list[tile_cnt]))
+        return self.readers[tile_cnt]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, index):
+        tile_cnt, grid = self.index[index]
+        if grid is None:
+            # torch seeds each worker differently, so the locations are not repeated among workers
+            h, w = self.tile_dims[tile_cnt]
+            y = int(torch.randint(0, max(h + 2 * self.pad - self.patch_size[0], 0) + 1, (1,)))
+            x = int(torch.randint(0, max(w + 2 * self.pad - self.patch_size[1], 0) + 1, (1,)))
+        else:
+            y, x = grid
+        rgb_reader, lbl_reader = self.get_reader(tile_cnt)
+        output_dict = dict()
+        output_dict['image'] = rgb_reader.read_patch(y, x, self.patch_size, self.pad)
+        lbl = lbl_reader.read_patch(y, x, self.patch_size, self.pad)
+        if self.decode_func:
+            lbl = self.decode_func(lbl)
+        if self.truth_val > 1:
+            lbl = lbl // self.truth_val
+        output_dict['mask'] = lbl.astype(np.uint8, copy=False)
+        return apply_transforms(output_dict, self.transforms, self.n_class, self.with_aux)
+
+
+def get_loader(data_path, file_name, transforms=None, n_class=2, with_aux=False, tile_kwargs=None, cache_bytes=0,
+               shuffle=True):
     """
     Get the appropriate loader with the given file type
     :param data_path: path to a preprocessed remote sensing dataset
     :param file_name: name of the data file, could be a text file or hdf5 file
     :param transforms: albumentation transforms
     :param aux_loss: if > 0, the dataloader will return patch-wise classification label
+    :param tile_kwargs: if not None, the file is a list of source tiles and the patches are sampled from the tiles on
+                        the fly by TileDataLoader, this is the dictionary of its parameters, e.g. patch_size
+    :param cache_bytes: byte budget of the shared decoded patch cache of RSDataLoader, 0 to disable the cache
+    :param shuffle: if the file is a shard list, this decides whether ShardDataLoader shuffles the samples
     :return: the corresponding loader
     """
+    if tile_kwargs is not None:
+        return TileDataLoader(data_path, file_name, transforms=transforms, n_class=n_class, with_aux=with_aux,
+                              **tile_kwargs)
     if file_name[-3:] == 'txt':
-        return RSDataLoader(data_path, file_name, transforms, n_class, with_aux=with_aux)
+        return RSDataLoader(data_path, file_name, transforms, n_class, with_aux=with_aux, cache_bytes=cache_bytes)
     elif file_name[-4:] == 'hdf5':
         return HDF5DataLoader(data_path, file_name, transforms, n_class)
+    elif file_name[-11:] == 'shards.json':
+        return ShardDataLoader(data_path, file_name, transforms, n_class, with_aux=with_aux, shuffle=shuffle)
     elif file_name[-1] == ']':
         # multi dataset
-        return RSDataLoader(data_path, file_name, transforms, n_class, with_aux=with_aux)
+        return RSDataLoader(data_path, file_name, transforms, n_class, with_aux=with_aux, cache_bytes=cache_bytes)
     else:
         raise NotImplementedError('File extension {} is not supportted yet'.format(os.path.splitext(file_name))[-1])
 
@@ -200,6 +573,74 @@ class MixedBatchSampler(data.sampler.Sampler):
                     yield self.offset[ds_cnt] + rand_idx[ds_cnt][(cnt*n_sample+curr_cnt) % self.ds_len[ds_cnt]]
 
 
+def get_fg_fractions(lbl_files, index_file=None, n_workers=0):
+    """
+    Get the fraction of foreground (label > 0) pixels of each label patch from the foreground index of the labels, see
+    fg_index.build_index(), the index is only built again when the label files change
+    :param lbl_files: list of label patches
+    :param index_file: npz file to keep the index, if None, the index is built in a temporary file
+    :param n_workers: #processes to read the labels in parallel
+    :return: array of the foreground fractions
+    """
+    if index_file is None:
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            return fg_index.build_index(lbl_files, os.path.join(tmp_dir, 'fg_index.npz'), with_boxes=False,
+                                        n_workers=n_workers).get_fg_fractions()
+    return fg_index.build_index(lbl_files, index_file, with_boxes=False, n_workers=n_workers).get_fg_fractions()
+
+
+def get_fg_index_file(file_list):
+    """
+    Get the foreground index file of a file list, it is saved beside the file list
+    :param file_list: path to the file list
+    :return: path to the index file
+    """
+    return '{}_fg.npz'.format(os.path.splitext(file_list)[0])
+
+
+class ForegroundBalancedSampler(data.sampler.Sampler):
+    def __init__(self, fg_fractions, ratio, fg_th=0):
+        """
+        Foreground balanced batch sampler where each batch has fixed number of positive and negative patches, this
+        complements MixedBatchSampler for sparse targets where most patches have no foreground pixels
+        The positive and negative patches are reshuffled every time they are used up, an epoch has as many samples as
+        the dataset
+        :param fg_fractions: foreground fraction of each patch, see get_fg_fractions()
+        :param ratio: #positive and #negative patches in each batch, the batch size of the loader should be sum(ratio)
+        :param fg_th: a patch is positive if its foreground fraction is greater than this
+        """
+        super(ForegroundBalancedSampler, self).__init__(fg_fractions)
+        assert len(ratio) == 2
+        fg_fractions = np.array(fg_fractions)
+        self.pos_idx = np.where(fg_fractions > fg_th)[0]
+        self.neg_idx = np.where(fg_fractions <= fg_th)[0]
+        self.ratio = ratio
+        self.batch_size = sum(ratio)
+        self.n_batch = len(fg_fractions) // self.batch_size
+        # fall back to the other pool if one of them is empty
+        if len(self.pos_idx) == 0:
+            self.pos_idx = self.neg_idx
+        if len(self.neg_idx) == 0:
+            self.neg_idx = self.pos_idx
+
+    def __len__(self):
+        return self.n_batch * self.batch_size
+
+    def __iter__(self):
+        pools = [self.pos_idx, self.neg_idx]
+        rand_idx = [np.random.permutation(pool) for pool in pools]
+        offsets = [0, 0]
+        for _ in range(self.n_batch):
+            for pool_cnt, n_sample in enumerate(self.ratio):
+                for _ in range(n_sample):
+                    if offsets[pool_cnt] == len(pools[pool_cnt]):
+                        rand_idx[pool_cnt] = np.random.permutation(pools[pool_cnt])
+                        offsets[pool_cnt] = 0
+                    yield int(rand_idx[pool_cnt][offsets[pool_cnt]])
+                    offsets[pool_cnt] += 1
+
+
 if __name__ == '__main__':
     from data import data_utils
     import albumentations as A
@@ -5,7 +5,10 @@
 
 # Built-in
 import os
+import json
+import tarfile
 from glob import glob
+from multiprocessing import Pool
 
 # Libs
 import h5py
@@ -44,7 +47,8 @@ def make_grid(tile_size, patch_size, overlap):
 
 def pad_image(img, pad, mode='reflect'):
     """
-    Symmetric pad pixels around images
+    Symmetric pad pixels around images, the data type of the image is preserved and all the channels are padded in
+    one call
     :param img: image to pad
     :param pad: list of #pixels pad around the image, if it is a scalar, it will be assumed to pad same number
                 number of pixels around 4 directions
@@ -54,19 +58,16 @@ def pad_image(img, pad, mode='reflect'):
     if type(pad) is not list:
         pad = [pad for i in range(4)]
     assert len(pad) == 4
-    if len(img.shape) == 2:
-        return np.pad(img, ((pad[0], pad[1]), (pad[2], pad[3])), mode)
-    else:
-        h, w, c = img.shape
-        pad_img = np.zeros((h + pad[0] + pad[1], w + pad[2] + pad[3], c))
-        for i in range(c):
-            pad_img[:, :, i] = np.pad(img[:, :, i], ((pad[0], pad[1]), (pad[2], pad[3])), mode)
-    return pad_img
+    if not any(pad):
+        return img
+    pad_width = ((pad[0], pad[1]), (pad[2], pad[3])) + ((0, 0), ) * (len(img.shape) - 2)
+    return np.pad(img, pad_width, mode)
 
 
 def crop_image(img, y, x, h, w):
     """
     Crop the image with given top-left anchor and corresponding width & height
+    The patch is a view of the image, no data is copied
     :param img: image to be cropped
     :param y: height of anchor
     :param x: width of anchor
@@ -74,10 +75,7 @@ def crop_image(img, y, x, h, w):
     :param w: width of the patch
     :return:
     """
-    if len(img.shape) == 2:
-        return img[y:y+w, x:x+h]
-    else:
-        return img[y:y+w, x:x+h, :]
+    return img[y:y+h, x:x+w, ...]
 
 
 def change_channel_order(data, to_channel_last=True):
@@ -184,7 +182,52 @@ def default_get_stats(img_dir, file_list):
     return np.stack([ds_mean, ds_std], axis=0)
 
 
-def patch_tile(rgb_file, gt_file, patch_size, pad, overlap):
+def get_patch_fractions(mask, grid_list, patch_size):
+    """
+    Get the fraction of True pixels in every patch of the grid, the counts are read from an integral image of the mask,
+    so the cost does not grow with the number or the overlap of the patches
+    :param mask: 2D boolean mask of the (padded) tile
+    :param grid_list: list of top left corners of the patches, as returned by make_grid()
+    :param patch_size: size of the patches, should be a tuple of (h, w)
+    :return: array of the fraction of True pixels in each patch
+    """
+    integral = np.pad(mask.astype(np.int64).cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)), mode='constant')
+    grid = np.array(grid_list, dtype=np.int64).reshape((-1, 2))
+    y, x = grid[:, 0], grid[:, 1]
+    h, w = patch_size
+    counts = integral[y + h, x + w] - integral[y, x + w] - integral[y + h, x] + integral[y, x]
+    return counts / (h * w)
+
+
+def filter_patches(rgb, gt, grid_list, patch_size, max_blank=None, min_fg=None, nodata_val=0):
+    """
+    Decide which patches of the grid to keep, a patch is rejected as blank if more than max_blank of its pixels are
+    no-data in every channel of the rgb, otherwise it is rejected as empty if less than min_fg of its pixels are
+    foreground (gt > 0) in the label
+    :param rgb: the (padded) rgb tile
+    :param gt: the (padded) gt tile
+    :param grid_list: list of top left corners of the patches, as returned by make_grid()
+    :param patch_size: size of the patches, should be a tuple of (h, w)
+    :param max_blank: max fraction of no-data pixels in a patch, if None, no patch will be rejected as blank
+    :param min_fg: min fraction of foreground pixels in a patch, if None, no patch will be rejected as empty
+    :param nodata_val: value of the no-data pixels, e.g. 0 for black borders or 255 for white borders
+    :return: boolean array of the patches to keep, #patches rejected as blank and #patches rejected as empty
+    """
+    keep = np.ones(len(grid_list), dtype=bool)
+    n_blank, n_empty = 0, 0
+    if max_blank is not None:
+        blank_mask = np.all(rgb == nodata_val, axis=-1) if rgb.ndim == 3 else rgb == nodata_val
+        keep = get_patch_fractions(blank_mask, grid_list, patch_size) <= max_blank
+        n_blank = int(np.sum(~keep))
+    if min_fg is not None:
+        fg_mask = np.any(gt > 0, axis=-1) if gt.ndim == 3 else gt > 0
+        empty = keep & (get_patch_fractions(fg_mask, grid_list, patch_size) < min_fg)
+        n_empty = int(np.sum(empty))
+        keep = keep & ~empty
+    return keep, n_blank, n_empty
+
+
+def patch_tile(rgb_file, gt_file, patch_size, pad, overlap, patch_filter=None, stats=None):
     """
     Extract the given rgb and gt tiles into patches
     :param rgb_file: path to the rgb file or the rgb imagery
@@ -192,6 +235,9 @@ def patch_tile(rgb_file, gt_file, patch_size, pad, overlap):
     :param patch_size: size of the patches, should be a tuple of (h, w)
     :param pad: #pixels to be padded around each tile, should be either one element or four elements
     :param overlap: #overlapping pixels between two patches in both vertical and horizontal direction
+    :param patch_filter: dictionary of the parameters of filter_patches() (max_blank, min_fg and nodata_val), if None,
+                         every patch will be yielded
+    :param stats: dictionary to accumulate the #patches rejected as blank and empty into, if None, they're not recorded
     :return: rgb and gt patches as well as coordinates
     """
     if isinstance(rgb_file, str) and isinstance(gt_file, str):
@@ -205,12 +251,455 @@ def patch_tile(rgb_file, gt_file, patch_size, pad, overlap):
     if pad > 0:
         rgb = pad_image(rgb, pad)
         gt = pad_image(gt, pad)
+    if patch_filter:
+        keep, n_blank, n_empty = filter_patches(rgb, gt, grid_list, patch_size, **patch_filter)
+        grid_list = [a for a, k in zip(grid_list, keep) if k]
+        if stats is not None:
+            stats['blank'] = stats.get('blank', 0) + n_blank
+            stats['empty'] = stats.get('empty', 0) + n_empty
     for y, x in grid_list:
         rgb_patch = crop_image(rgb, y, x, patch_size[0], patch_size[1])
         gt_patch = crop_image(gt, y, x, patch_size[0], patch_size[1])
         yield rgb_patch, gt_patch, y, x
 
 
+def scale_label(gt_patch):
+    """
+    Scale the label from 0/255 to 0/1, this is used by the datasets whose labels are saved as 255
+    The floor division keeps the data type, which gives the same result as casting gt_patch/255 to uint8
+    :param gt_patch: the label patch
+    :return: the scaled label patch
+    """
+    return gt_patch // 255
+
+
+def make_color_lut(color_map, default=0):
+    """
+    Make a lookup table from 24-bit rgb colors to class ids, so a color coded label can be decoded with one gather
+    :param color_map: dictionary of class id and its (r, g, b) color
+    :param default: class id of the colors that are not in the color map
+    :return: array of 2^24 class ids, indexed by r << 16 | g << 8 | b
+    """
+    lut = np.full(1 << 24, default, dtype=np.uint8)
+    for class_id, (r, g, b) in color_map.items():
+        lut[(r << 16) | (g << 8) | b] = class_id
+    return lut
+
+
+def make_palette(color_map):
+    """
+    Make a palette from class ids to rgb colors, so a class map can be encoded with one gather
+    :param color_map: dictionary of class id and its (r, g, b) color
+    :return: array of (#classes, 3) colors, indexed by class id
+    """
+    palette = np.zeros((max(color_map.keys()) + 1, 3), dtype=np.uint8)
+    for class_id, color in color_map.items():
+        palette[class_id] = color
+    return palette
+
+
+def decode_color_label(gt_map, lut):
+    """
+    Decode a color coded label into class ids
+    :param gt_map: the color coded label of h*w*3 (extra channels are ignored)
+    :param lut: the lookup table made by make_color_lut()
+    :return: the class map of h*w
+    """
+    gt_map = gt_map.astype(np.uint32, copy=False)
+    return lut[(gt_map[..., 0] << 16) | (gt_map[..., 1] << 8) | gt_map[..., 2]]
+
+
+def encode_color_label(gt, palette):
+    """
+    Encode a class map into a color coded label
+    :param gt: the class map of h*w
+    :param palette: the palette made by make_palette()
+    :return: the color coded label of h*w*3
+    """
+    return palette[gt.astype(np.intp, copy=False)]
+
+
+def get_patch_codec(codec='jpg', quality=None):
+    """
+    Get the file formats and saving parameters of the patches, the labels are always saved losslessly
+    :param codec: format of the image patches, could be
+                  npy: raw arrays, no decoding cost but the largest files
+                  png: uncompressed png, lossless
+                  jpg: jpeg with the given quality
+                  webp: webp with the given quality, quality of 100 means lossless webp
+    :param quality: quality of the lossy formats, if None, the PIL default will be used
+    :return: dictionary of the image and label extensions and the saving parameters
+    """
+    codec = misc_utils.stem_string(codec)
+    if codec == 'npy':
+        return {'img_ext': 'npy', 'lbl_ext': 'npy', 'img_kwargs': {}, 'lbl_kwargs': {}}
+    elif codec == 'png':
+        return {'img_ext': 'png', 'lbl_ext': 'png', 'img_kwargs': {'compress_level': 0},
+                'lbl_kwargs': {'compress_level': 0}}
+    elif codec in ['jpg', 'jpeg']:
+        img_kwargs = {} if quality is None else {'quality': int(quality)}
+        return {'img_ext': 'jpg', 'lbl_ext': 'png', 'img_kwargs': img_kwargs, 'lbl_kwargs': {}}
+    elif codec == 'webp':
+        if quality is None:
+            img_kwargs = {}
+        elif quality >= 100:
+            img_kwargs = {'lossless': True}
+        else:
+            img_kwargs = {'quality': int(quality)}
+        return {'img_ext': 'webp', 'lbl_ext': 'png', 'img_kwargs': img_kwargs, 'lbl_kwargs': {}}
+    else:
+        raise NotImplementedError('Patch codec {} is not supported'.format(codec))
+
+
+def extract_tile(rgb_file, gt_file, patch_dir, prefix, patch_size, pad, overlap, tile_func=None, lbl_func=None,
+                 codec='jpg', quality=None, save_patches=True, patch_filter=None):
+    """
+    Extract one tile into patches and save them into the patch directory
+    This is the per-tile job of parallel_extract(), it needs to be picklable so tile_func and lbl_func should be module
+    level functions
+    :param rgb_file: path to the rgb file
+    :param gt_file: path to the gt file
+    :param patch_dir: directory to save the patches
+    :param prefix: prefix of the patch names, patches are named as {prefix}_y{y}x{x}.{ext}
+    :param patch_size: size of the patches, should be a tuple of (h, w)
+    :param pad: #pixels to be padded around each tile, should be either one element or four elements
+    :param overlap: #overlapping pixels between two patches in both vertical and horizontal direction
+    :param tile_func: function that yields rgb patch, gt patch, y and x of the tile, if None, patch_tile() is used
+    :param lbl_func: function applied to the label patches before they are saved
+    :param codec: format of the image patches, see get_patch_codec()
+    :param quality: quality of the lossy formats, if None, the PIL default will be used
+    :param save_patches: if False, only the records will be made, this is useful when the patches already exist
+    :param patch_filter: dictionary of the parameters of filter_patches(), it is passed to tile_func, if None, every
+                         patch is kept
+    :return: dictionary of the records in the file list, each one is "img_patch lbl_patch\n", and the #patches
+             rejected by the filter
+    """
+    if tile_func is None:
+        tile_func = patch_tile
+    codec = get_patch_codec(codec, quality)
+    records = []
+    rejected = {'blank': 0, 'empty': 0}
+    filter_kwargs = {'patch_filter': patch_filter, 'stats': rejected} if patch_filter else {}
+    for rgb_patch, gt_patch, y, x in tile_func(rgb_file, gt_file, patch_size, pad, overlap, **filter_kwargs):
+        img_patchname = '{}_y{}x{}.{}'.format(prefix, int(y), int(x), codec['img_ext'])
+        lbl_patchname = '{}_y{}x{}.{}'.format(prefix, int(y), int(x), codec['lbl_ext'])
+        if save_patches:
+            if lbl_func is not None:
+                gt_patch = lbl_func(gt_patch)
+            misc_utils.save_file(os.path.join(patch_dir, img_patchname), rgb_patch.astype(np.uint8, copy=False),
+                                 **codec['img_kwargs'])
+            misc_utils.save_file(os.path.join(patch_dir, lbl_patchname), gt_patch.astype(np.uint8, copy=False),
+                                 **codec['lbl_kwargs'])
+        records.append('{} {}\n'.format(img_patchname, lbl_patchname))
+    return {'records': records, 'rejected': rejected}
+
+
+def _extract_shard(args):
+    """
+    Run one per-tile job and write its records into the manifest of the tile
+    :param args: tuple of the per-tile function, the manifest file, the signature of the tile and the arguments of the
+                 per-tile function
+    :return: the records of the tile
+    """
+    tile_func, manifest_file, signature, tile_args = args
+    records = tile_func(*tile_args)
+    misc_utils.save_manifest(manifest_file, signature, records)
+    return records
+
+
+def parallel_extract(tile_func, tasks, save_dir, n_workers=0, list_name='file_list_{}.txt', splits=('train', 'valid'),
+                     force_run=False):
+    """
+    Fan the tiles out to a pool of worker processes, each tile writes its records into its own manifest, the records
+    are then merged in the order of the tasks, so the file lists are the same no matter how many workers are used
+    The manifest of a tile is keyed by its source files and records their size and mtime as well as the arguments of
+    the tile, a tile whose manifest matches is skipped, so an interrupted run resumes where it stopped and a rerun only
+    extracts the tiles that have changed
+    The #tiles, #patches and #patches rejected by the patch filter of each file list are written into manifest.json in
+    the save directory
+    :param tile_func: module level function that extracts one tile and returns the records, e.g. extract_tile(), it
+                      could either return the list of records or a dictionary of the records and the rejected counts
+    :param tasks: list of (split, tile_args), split is the name of the file list the tile goes to (e.g. train or
+                  valid), tile_args is a tuple of the arguments of tile_func
+    :param save_dir: directory to save the file lists
+    :param n_workers: #worker processes, if less than 2, the tiles are extracted in the current process
+    :param list_name: name pattern of the file lists
+    :param splits: name of the file lists that are always written, even if no tile goes to them
+    :param force_run: if True, the manifests are ignored and every tile will be extracted
+    :return: dictionary of split name and the path to the file list
+    """
+    manifest_dir = os.path.join(save_dir, 'manifests')
+    misc_utils.make_dir_if_not_exist(manifest_dir)
+    tile_records = [None for _ in tasks]
+    jobs, job_ids = [], []
+    for cnt, (_, tile_args) in enumerate(tasks):
+        files = [a for a in tile_args if isinstance(a, str) and os.path.isfile(a)]
+        params = ['{}.{}'.format(tile_func.__module__, tile_func.__name__)] + \
+                 [a for a in tile_args if not (isinstance(a, str) and os.path.isfile(a))]
+        signature = misc_utils.get_tile_signature(files, params)
+        manifest_file = misc_utils.get_manifest_file(manifest_dir, files)
+        if not force_run:
+            tile_records[cnt] = misc_utils.load_manifest(manifest_file, signature)
+        if tile_records[cnt] is None:
+            jobs.append((tile_func, manifest_file, signature, tile_args))
+            job_ids.append(cnt)
+    print('{} tiles to extract, {} tiles are up to date'.format(len(jobs), len(tasks) - len(jobs)))
+    if n_workers > 1:
+        with Pool(n_workers) as pool:
+            job_records = list(tqdm(pool.imap(_extract_shard, jobs), total=len(jobs), desc='Tile-wise'))
+    else:
+        job_records = [_extract_shard(job) for job in tqdm(jobs, desc='Tile-wise')]
+    for cnt, records in zip(job_ids, job_records):
+        tile_records[cnt] = records
+
+    # merge the records
+    records = {split: [] for split in splits}
+    summary = {split: {'tiles': 0, 'patches': 0, 'rejected': {'blank': 0, 'empty': 0}} for split in splits}
+    for (split, _), split_records in zip(tasks, tile_records):
+        rejected = {}
+        if isinstance(split_records, dict):
+            rejected = split_records['rejected']
+            split_records = split_records['records']
+        records.setdefault(split, []).extend(split_records)
+        split_summary = summary.setdefault(split, {'tiles': 0, 'patches': 0, 'rejected': {'blank': 0, 'empty': 0}})
+        split_summary['tiles'] += 1
+        split_summary['patches'] += len(split_records)
+        for key, val in rejected.items():
+            split_summary['rejected'][key] = split_summary['rejected'].get(key, 0) + val
+    list_files = {}
+    for split, split_records in records.items():
+        list_files[split] = os.path.join(save_dir, list_name.format(split))
+        misc_utils.save_file(list_files[split], split_records)
+        summary[split]['file_list'] = os.path.basename(list_files[split])
+        print('{}: {} patches, rejected {} blank and {} empty'.format(
+            split, summary[split]['patches'], summary[split]['rejected']['blank'], summary[split]['rejected']['empty']))
+    misc_utils.save_file(os.path.join(save_dir, 'manifest.json'), summary)
+    return list_files
+
+
+def _pack_tile(args):
+    """
+    Cut one tile into patches for pack_tiles()
+    :param args: tuple of tile_func, lbl_func, rgb file, gt file, patch size, pad, overlap and patch filter
+    :return: stacked image patches, label patches, their y, x coordinates and the #patches rejected by the filter, the
+             stacked arrays are None if every patch of the tile is rejected
+    """
+    tile_func, lbl_func, rgb_file, gt_file, patch_size, pad, overlap, patch_filter = args
+    imgs, lbls, coords = [], [], []
+    rejected = {'blank': 0, 'empty': 0}
+    filter_kwargs = {'patch_filter': patch_filter, 'stats': rejected} if patch_filter else {}
+    for rgb_patch, gt_patch, y, x in tile_func(rgb_file, gt_file, patch_size, pad, overlap, **filter_kwargs):
+        if lbl_func is not None:
+            gt_patch = lbl_func(gt_patch)
+        imgs.append(rgb_patch.astype(np.uint8, copy=False))
+        lbls.append(gt_patch.astype(np.uint8, copy=False))
+        coords.append((y, x))
+    if len(imgs) == 0:
+        return None, None, None, rejected
+    return np.stack(imgs, axis=0), np.stack(lbls, axis=0), np.array(coords, dtype=np.int32), rejected
+
+
+class _HDF5Store(object):
+    def __init__(self, file_name, chunk_size, compression):
+        self.file = h5py.File(file_name, mode='w')
+        self.chunk_size = chunk_size
+        self.compression = compression
+
+    def create(self, name, shape, dtype):
+        self.file.create_dataset(name, (0, *shape), dtype, maxshape=(None, *shape),
+                                 chunks=(self.chunk_size, *shape), compression=self.compression)
+
+    def append(self, name, data):
+        dataset = self.file[name]
+        n = dataset.shape[0]
+        dataset.resize(n + data.shape[0], axis=0)
+        dataset[n:n + data.shape[0], ...] = data
+
+    def set_attr(self, name, value):
+        self.file.attrs[name] = value
+
+    def write_strings(self, name, values):
+        # attributes live in the object header which is limited to 64KB, so long lists of strings go into a dataset
+        self.file.create_dataset(name, data=np.array(values, dtype=h5py.string_dtype()), dtype=h5py.string_dtype())
+
+    def close(self):
+        self.file.close()
+
+
+class _ZarrStore(object):
+    def __init__(self, file_name, chunk_size, compression):
+        import zarr
+        self.group = zarr.open_group(file_name, mode='w')
+        self.chunk_size = chunk_size
+        self.compression = compression
+
+    def create(self, name, shape, dtype):
+        kwargs = {}
+        if self.compression is None:
+            kwargs['compressor'] = None
+        self.group.zeros(name, shape=(0, *shape), chunks=(self.chunk_size, *shape), dtype=dtype, **kwargs)
+
+    def append(self, name, data):
+        self.group[name].append(data, axis=0)
+
+    def set_attr(self, name, value):
+        self.group.attrs[name] = value
+
+    def write_strings(self, name, values):
+        self.group.array(name, np.array(values, dtype=str))
+
+    def close(self):
+        pass
+
+
+def pack_tiles(tasks, save_dir, patch_size, pad, overlap, tile_func=None, lbl_func=None, chunk_size=64,
+               compression='lzf', backend='hdf5', n_workers=0, patch_filter=None):
+    """
+    Cut patches straight from the source tiles into chunked array stores, no patch image file is written
+    One store is made for each split ({split}.hdf5 or {split}.zarr), it has the datasets img (n*h*w*c), lbl (n*h*w),
+    coords (n*2, y and x in the padded tile), tile_id (n) and tile_names (the names of the tiles), the #patches
+    rejected by the patch filter are stored in the rejected attribute. The patches are buffered and
+    written in blocks of chunk_size patches, so every write except the last one covers exactly one chunk. The img and
+    lbl datasets are compatible with data_loader.HDF5DataLoader
+    :param tasks: list of (split, (rgb_file, gt_file, tile_name))
+    :param save_dir: directory to save the stores
+    :param patch_size: size of the patches, should be a tuple of (h, w)
+    :param pad: #pixels to be padded around each tile, should be either one element or four elements
+    :param overlap: #overlapping pixels between two patches in both vertical and horizontal direction
+    :param tile_func: function that yields rgb patch, gt patch, y and x of the tile, if None, patch_tile() is used
+    :param lbl_func: function applied to the label patches before they are stored
+    :param chunk_size: #patches per chunk
+    :param compression: compression of the datasets, lzf or gzip for hdf5, None to store uncompressed, zarr uses its
+                        default compressor unless this is None
+    :param backend: hdf5 or zarr
+    :param n_workers: #processes to cut the tiles in parallel, the stores are always written by the current process
+    :param patch_filter: dictionary of the parameters of filter_patches(), it is passed to tile_func, if None, every
+                         patch is kept
+    :return: dictionary of split name and the path to the store
+    """
+    if tile_func is None:
+        tile_func = patch_tile
+    backend = misc_utils.stem_string(backend)
+    if backend == 'hdf5':
+        store_class = _HDF5Store
+    elif backend == 'zarr':
+        store_class = _ZarrStore
+    else:
+        raise NotImplementedError('Backend {} is not supported'.format(backend))
+    misc_utils.make_dir_if_not_exist(save_dir)
+
+    splits = []
+    for split, _ in tasks:
+        if split not in splits:
+            splits.append(split)
+    store_files = {}
+    for split in splits:
+        split_tiles = [tile for s, tile in tasks if s == split]
+        store_files[split] = os.path.join(save_dir, '{}.{}'.format(split, backend))
+        store = store_class(store_files[split], chunk_size, compression)
+        jobs = [(tile_func, lbl_func, rgb_file, gt_file, patch_size, pad, overlap, patch_filter)
+                for rgb_file, gt_file, _ in split_tiles]
+        if n_workers > 1:
+            pool = Pool(n_workers)
+            results = pool.imap(_pack_tile, jobs)
+        else:
+            pool = None
+            results = map(_pack_tile, jobs)
+
+        buffer = {'img': [], 'lbl': [], 'coords': [], 'tile_id': []}
+        buffer_size = 0
+        created = False
+        rejected = {'blank': 0, 'empty': 0}
+        try:
+            for tile_id, (imgs, lbls, coords, tile_rejected) in enumerate(tqdm(results, total=len(jobs), desc=split)):
+                for key, val in tile_rejected.items():
+                    rejected[key] += val
+                if imgs is None:
+                    continue
+                if not created:
+                    created = True
+                    store.create('img', imgs.shape[1:], np.uint8)
+                    store.create('lbl', lbls.shape[1:], np.uint8)
+                    store.create('coords', (2, ), np.int32)
+                    store.create('tile_id', (), np.int32)
+                buffer['img'].append(imgs)
+                buffer['lbl'].append(lbls)
+                buffer['coords'].append(coords)
+                buffer['tile_id'].append(np.full(imgs.shape[0], tile_id, dtype=np.int32))
+                buffer_size += imgs.shape[0]
+                # write whole chunks only, the remainder stays in the buffer
+                if buffer_size >= chunk_size:
+                    n_write = buffer_size - buffer_size % chunk_size
+                    for name in buffer:
+                        data = np.concatenate(buffer[name], axis=0)
+                        store.append(name, data[:n_write])
+                        buffer[name] = [data[n_write:]]
+                    buffer_size -= n_write
+            if buffer_size > 0:
+                for name in buffer:
+                    store.append(name, np.concatenate(buffer[name], axis=0))
+            store.write_strings('tile_names', [tile_name for _, _, tile_name in split_tiles])
+            store.set_attr('rejected', json.dumps(rejected))
+            print('{}: rejected {} blank and {} empty patches'.format(split, rejected['blank'], rejected['empty']))
+        finally:
+            store.close()
+            if pool is not None:
+                pool.close()
+                pool.join()
+    return store_files
+
+
+def _write_tar_shard(args):
+    """
+    Pack the encoded image and label patches into one tar shard, the patch files are copied as they are
+    :param args: tuple of the shard file and the list of (key, img_file, lbl_file)
+    :return: #samples in the shard
+    """
+    shard_file, samples = args
+    tmp_file = '{}.tmp'.format(shard_file)
+    with tarfile.open(tmp_file, 'w') as tar:
+        for key, img_file, lbl_file in samples:
+            tar.add(img_file, arcname='{}.img{}'.format(key, os.path.splitext(img_file)[1]))
+            tar.add(lbl_file, arcname='{}.lbl{}'.format(key, os.path.splitext(lbl_file)[1]))
+    os.replace(tmp_file, shard_file)
+    return len(samples)
+
+
+def write_shards(parent_path, file_list, save_dir, shard_size=1000, shuffle=True, random_seed=1, n_workers=0):
+    """
+    Convert a file list of patches into large sequential tar shards, each sample is stored as two consecutive members
+    {key}.img.{ext} and {key}.lbl.{ext} (the same layout as WebDataset), the shards are listed in
+    {file_list}_shards.json which is read by data_loader.ShardDataLoader
+    :param parent_path: directory of the patches
+    :param file_list: the file list, each row contains rgb and gt files separated by space
+    :param save_dir: directory to save the shards and the shard list
+    :param shard_size: #samples in each shard
+    :param shuffle: if True, the samples are shuffled before they are packed, so the patches of one tile are spread
+                    over the shards
+    :param random_seed: random seed of the shuffling
+    :param n_workers: #processes to write the shards in parallel
+    :return: path to the shard list
+    """
+    misc_utils.make_dir_if_not_exist(save_dir)
+    rows = [a.strip().split(' ')[:2] for a in misc_utils.load_file(file_list) if a.strip()]
+    order = np.random.RandomState(random_seed).permutation(len(rows)) if shuffle else np.arange(len(rows))
+    prefix = os.path.splitext(os.path.basename(file_list))[0]
+    jobs = []
+    for shard_cnt, start in enumerate(range(0, len(rows), shard_size)):
+        samples = [('{:09d}'.format(a), os.path.join(parent_path, rows[a][0]), os.path.join(parent_path, rows[a][1]))
+                   for a in order[start:start + shard_size]]
+        jobs.append((os.path.join(save_dir, '{}-{:06d}.tar'.format(prefix, shard_cnt)), samples))
+    if n_workers > 1:
+        with Pool(n_workers) as pool:
+            counts = list(tqdm(pool.imap(_write_tar_shard, jobs), total=len(jobs), desc='Shards'))
+    else:
+        counts = [_write_tar_shard(job) for job in tqdm(jobs, desc='Shards')]
+    shard_list = os.path.join(save_dir, '{}_shards.json'.format(prefix))
+    misc_utils.save_file(shard_list, {'shards': [os.path.basename(shard_file) for shard_file, _ in jobs],
+                                      'counts': counts})
+    return shard_list
+
+
 def get_custom_ds_stats(ds_name, img_dir):
     def get_stats(img_dir):
         rgb_imgs = natsorted(glob(os.path.join(img_dir, '*.jpg')))
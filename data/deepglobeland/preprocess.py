@@ -10,10 +10,9 @@ import os
 
 # Libs
 import numpy as np
-from tqdm import tqdm
 
 # Own modules
-from data import data_utils
+from data import data_utils, fg_index
 from mrs_utils import misc_utils, process_block
 
 # Settings
@@ -21,18 +20,10 @@ DS_NAME = 'DeepGlobeLand'
 MEAN = (0.40851371, 0.37964116, 0.28266888)
 STD = (0.12667853, 0.10076384, 0.08919973)
 CLASS_NAMES = ['Urbanland', 'Agricultureland', 'Rangeland', 'Forestland', 'Water', 'Barrenland', 'Unknown']
+# every class is foreground here (class 0 is urban land), so only the no-data (black) patches are dropped
+PATCH_FILTER = {'max_blank': 0.5, 'min_fg': None, 'nodata_val': 0}
 
-# Decoder
-DECODER = {
-    255255: 0,          # Urban land
-    255255000: 1,       # Agriculture land
-    255000255: 2,       # Rangeland
-    255000: 3,          # Forest land
-    255: 4,             # Water
-    255255255: 5,       # Barren land
-    0: 6                # Unknown
-}
-
+# Encoder
 ENCODER = {
     0: (0, 255, 255),           # Urban land
     1: (255, 255, 0),           # Agriculture land
@@ -44,19 +35,20 @@ ENCODER = {
 }
 
 
-def decode_map(gt_map, decoder=DECODER):
-    dc_func = lambda x: decoder[x]
-    gt_map = gt_map.astype(np.float)
-    new_map = gt_map[:, :, 0] * 1000000 + gt_map[:, :, 1] * 1000 + gt_map[:, :, 2]
-    return np.vectorize(dc_func)(new_map.astype(np.long))
+# the lookup table and palette of the color coded labels, colors that are not in the encoder are unknown
+LUT = data_utils.make_color_lut(ENCODER, default=6)
+PALETTE = data_utils.make_palette(ENCODER)
+
 
+def decode_map(gt_map, lut=LUT):
+    return data_utils.decode_color_label(gt_map, lut)
 
-def encode_map(gt, encoder=ENCODER):
-    dc_func = lambda x: encoder[x]
-    return np.stack(np.vectorize(dc_func)(gt.astype(np.long)), axis=-1)
 
+def encode_map(gt, palette=PALETTE):
+    return data_utils.encode_color_label(gt, palette)
 
-def patch_tile(rgb_file, gt_file, patch_size, pad, overlap):
+
+def patch_tile(rgb_file, gt_file, patch_size, pad, overlap, patch_filter=None, stats=None):
     """
     Extract the given rgb and gt tiles into patches
     :param rgb_file: path to the rgb file
@@ -64,49 +56,49 @@ def patch_tile(rgb_file, gt_file, patch_size, pad, overlap):
     :param patch_size: size of the patches, should be a tuple of (h, w)
     :param pad: #pixels to be padded around each tile, should be either one element or four elements
     :param overlap: #overlapping pixels between two patches in both vertical and horizontal direction
+    :param patch_filter: thresholds to drop the blank and empty patches, see data_utils.filter_patches()
+    :param stats: dictionary to accumulate the #patches rejected by the patch filter into
     :return: rgb and gt patches as well as coordinates
     """
     rgb = misc_utils.load_file(rgb_file)
     gt_mask = misc_utils.load_file(gt_file)
-    gt = decode_map(gt_mask, DECODER)
+    gt = decode_map(gt_mask)
+    return data_utils.patch_tile(rgb, gt, patch_size, pad, overlap, patch_filter, stats)
 
-    np.testing.assert_array_equal(rgb.shape[:2], gt.shape[:2])
-    grid_list = data_utils.make_grid(np.array(rgb.shape[:2]) + 2 * pad, patch_size, overlap)
-    if pad > 0:
-        rgb = data_utils.pad_image(rgb, pad)
-        gt = data_utils.pad_image(gt, pad)
-    for y, x in grid_list:
-        rgb_patch = data_utils.crop_image(rgb, y, x, patch_size[0], patch_size[1])
-        gt_patch = data_utils.crop_image(gt, y, x, patch_size[0], patch_size[1])
 
-        yield rgb_patch, gt_patch, y, x
+def extract_tile(rgb_file, gt_file, patch_dir, prefix, patch_size, pad, overlap, codec='jpg', quality=None,
+                 patch_filter=None):
+    """
+    Extract one deepglobe land tile into patches, the color coded labels are decoded into class ids
+    :return: records in the file list and #patches rejected by the patch filter
+    """
+    return data_utils.extract_tile(rgb_file, gt_file, patch_dir, prefix, patch_size, pad, overlap,
+                                   tile_func=patch_tile, codec=codec, quality=quality, patch_filter=patch_filter)
 
 
-def patch_deepglobeland(data_dir, save_dir, patch_size, pad, overlap, valid_percent=0.14):
+def patch_deepglobeland(data_dir, save_dir, patch_size, pad, overlap, valid_percent=0.14, n_workers=0, pack=None,
+                        codec='jpg', quality=None, patch_filter=PATCH_FILTER):
     # create folders and files
     patch_dir = os.path.join(save_dir, 'patches')
     misc_utils.make_dir_if_not_exist(patch_dir)
-    record_file_train = open(os.path.join(save_dir, 'file_list_train.txt'), 'w+')
-    record_file_valid = open(os.path.join(save_dir, 'file_list_valid.txt'), 'w+')
 
     # make folds
     files = data_utils.get_img_lbl(os.path.join(data_dir, 'land-train', 'land-train'), 'sat.jpg', 'mask.png')
     valid_size = int(len(files) * valid_percent)
 
-    for cnt, (img_file, lbl_file) in enumerate(tqdm(files)):
+    tasks = []
+    for cnt, (img_file, lbl_file) in enumerate(files):
         city_name = os.path.splitext(os.path.basename(img_file))[0].split('_')[0]
-        for rgb_patch, gt_patch, y, x in patch_tile(img_file, lbl_file, patch_size, pad, overlap):
-            img_patchname = '{}_y{}x{}.jpg'.format(city_name, int(y), int(x))
-            lbl_patchname = '{}_y{}x{}.png'.format(city_name, int(y), int(x))
-            misc_utils.save_file(os.path.join(patch_dir, img_patchname), rgb_patch.astype(np.uint8))
-            misc_utils.save_file(os.path.join(patch_dir, lbl_patchname), gt_patch.astype(np.uint8))
-
-            if cnt < valid_size:
-                record_file_valid.write('{} {}\n'.format(img_patchname, lbl_patchname))
-            else:
-                record_file_train.write('{} {}\n'.format(img_patchname, lbl_patchname))
-    record_file_train.close()
-    record_file_valid.close()
+        split = 'valid' if cnt < valid_size else 'train'
+        tasks.append((split, (img_file, lbl_file, patch_dir, city_name, patch_size, pad, overlap, codec, quality,
+                              patch_filter)))
+    if pack:
+        # cut the patches straight into array stores instead of patch files
+        data_utils.pack_tiles([(split, (args[0], args[1], args[3])) for split, args in tasks], save_dir, patch_size,
+                              pad, overlap, tile_func=patch_tile, backend=pack, n_workers=n_workers,
+                              patch_filter=patch_filter)
+    else:
+        data_utils.parallel_extract(extract_tile, tasks, save_dir, n_workers)
 
 
 def get_images(data_dir, valid_percent=0.14):
@@ -151,18 +143,21 @@ def get_stats_pb(img_dir):
     return val, val_test
 
 
-def get_class_distribution(img_dir):
+def get_class_distribution(img_dir, n_workers=0):
+    """
+    Get the #pixels of each class in the training labels, the counts are read from the foreground index of the labels,
+    which is built once and saved as fg_index.npz in img_dir
+    :param img_dir: path to the original deepglobe land dataset
+    :param n_workers: #processes to index the labels in parallel
+    :return: array of the #pixels of each class
+    """
     dirs = ['land-train/land-train', ]
     gt_imgs = []
-    cnt = np.zeros(7)
     for dir_ in dirs:
         gt_imgs.extend([a[1] for a in data_utils.get_img_lbl(os.path.join(img_dir, dir_), 'sat.jpg', 'mask.png')])
-    for gt_img in tqdm(gt_imgs):
-        gt = misc_utils.load_file(gt_img)
-        gt = decode_map(gt)
-        hist, _ = np.histogram(gt, bins=np.arange(8))
-        cnt += hist
-    return cnt
+    index = fg_index.build_index(gt_imgs, os.path.join(img_dir, 'fg_index.npz'), n_class=len(CLASS_NAMES),
+                                 lbl_func=decode_map, n_workers=n_workers)
+    return index.class_distribution()[:len(CLASS_NAMES)]
 
 
 if __name__ == '__main__':
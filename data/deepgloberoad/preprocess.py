@@ -10,7 +10,6 @@ import os
 
 # Libs
 import numpy as np
-from tqdm import tqdm
 
 # Own modules
 from data import data_utils
@@ -20,13 +19,15 @@ from mrs_utils import misc_utils, process_block
 DS_NAME = 'DeepGlobeRoad'
 MEAN = (0.40994515, 0.38314009, 0.28864455)
 STD = (0.12889884, 0.10563929, 0.09726452)
+# patches that are mostly no-data (black) are dropped, set min_fg to also drop the patches without roads
+PATCH_FILTER = {'max_blank': 0.5, 'min_fg': None, 'nodata_val': 0}
 
 
 def decode_map(gt_map):
     return gt_map[:, :, 0]
 
 
-def patch_tile(rgb_file, gt_file, patch_size, pad, overlap):
+def patch_tile(rgb_file, gt_file, patch_size, pad, overlap, patch_filter=None, stats=None):
     """
     Extract the given rgb and gt tiles into patches
     :param rgb_file: path to the rgb file
@@ -34,30 +35,33 @@ def patch_tile(rgb_file, gt_file, patch_size, pad, overlap):
     :param patch_size: size of the patches, should be a tuple of (h, w)
     :param pad: #pixels to be padded around each tile, should be either one element or four elements
     :param overlap: #overlapping pixels between two patches in both vertical and horizontal direction
+    :param patch_filter: thresholds to drop the blank and empty patches, see data_utils.filter_patches()
+    :param stats: dictionary to accumulate the #patches rejected by the patch filter into
     :return: rgb and gt patches as well as coordinates
     """
     rgb = misc_utils.load_file(rgb_file)
     gt = misc_utils.load_file(gt_file)[:, :, 0]
-    np.testing.assert_array_equal(rgb.shape[:2], gt.shape)
-    grid_list = data_utils.make_grid(np.array(rgb.shape[:2]) + 2 * pad, patch_size, overlap)
-    if pad > 0:
-        rgb = data_utils.pad_image(rgb, pad)
-        gt = data_utils.pad_image(gt, pad)
-    for y, x in grid_list:
-        rgb_patch = data_utils.crop_image(rgb, y, x, patch_size[0], patch_size[1])
-        gt_patch = data_utils.crop_image(gt, y, x, patch_size[0], patch_size[1])
+    return data_utils.patch_tile(rgb, gt, patch_size, pad, overlap, patch_filter, stats)
 
-        yield rgb_patch, gt_patch, y, x
 
+def extract_tile(rgb_file, gt_file, patch_dir, prefix, patch_size, pad, overlap, codec='jpg', quality=None,
+                 patch_filter=None):
+    """
+    Extract one deepglobe road tile into patches, the labels are scaled from 255 to 1
+    :return: records in the file list and #patches rejected by the patch filter
+    """
+    return data_utils.extract_tile(rgb_file, gt_file, patch_dir, prefix, patch_size, pad, overlap,
+                                   tile_func=patch_tile, lbl_func=data_utils.scale_label, codec=codec,
+                                   quality=quality, patch_filter=patch_filter)
 
-def patch_deepgloberoad(data_dir, save_dir, patch_size, pad, overlap, valid_percent=0.14):
+
+def patch_deepgloberoad(data_dir, save_dir, patch_size, pad, overlap, valid_percent=0.14, n_workers=0, pack=None,
+                        codec='jpg', quality=None, patch_filter=PATCH_FILTER):
     dirs = ['road_trainv1/train', 'road_trainv2/train']
 
     # create folders and files
     patch_dir = os.path.join(save_dir, 'patches')
     misc_utils.make_dir_if_not_exist(patch_dir)
-    record_file_train = open(os.path.join(save_dir, 'file_list_train.txt'), 'w+')
-    record_file_valid = open(os.path.join(save_dir, 'file_list_valid.txt'), 'w+')
 
     # make folds
     files = []
@@ -65,20 +69,19 @@ def patch_deepgloberoad(data_dir, save_dir, patch_size, pad, overlap, valid_perc
         files.extend(data_utils.get_img_lbl(os.path.join(data_dir, dir_), 'sat.jpg', 'mask.png'))
     valid_size = int(len(files) * valid_percent)
 
-    for cnt, (img_file, lbl_file) in enumerate(tqdm(files)):
+    tasks = []
+    for cnt, (img_file, lbl_file) in enumerate(files):
         city_name = os.path.splitext(os.path.basename(img_file))[0].split('_')[0]
-        for rgb_patch, gt_patch, y, x in patch_tile(img_file, lbl_file, patch_size, pad, overlap):
-            img_patchname = '{}_y{}x{}.jpg'.format(city_name, int(y), int(x))
-            lbl_patchname = '{}_y{}x{}.png'.format(city_name, int(y), int(x))
-            misc_utils.save_file(os.path.join(patch_dir, img_patchname), rgb_patch.astype(np.uint8))
-            misc_utils.save_file(os.path.join(patch_dir, lbl_patchname), (gt_patch / 255).astype(np.uint8))
-
-            if cnt < valid_size:
-                record_file_valid.write('{} {}\n'.format(img_patchname, lbl_patchname))
-            else:
-                record_file_train.write('{} {}\n'.format(img_patchname, lbl_patchname))
-    record_file_train.close()
-    record_file_valid.close()
+        split = 'valid' if cnt < valid_size else 'train'
+        tasks.append((split, (img_file, lbl_file, patch_dir, city_name, patch_size, pad, overlap, codec, quality,
+                              patch_filter)))
+    if pack:
+        # cut the patches straight into array stores instead of patch files
+        data_utils.pack_tiles([(split, (args[0], args[1], args[3])) for split, args in tasks], save_dir, patch_size,
+                              pad, overlap, tile_func=patch_tile, lbl_func=data_utils.scale_label,
+                              backend=pack, n_workers=n_workers, patch_filter=patch_filter)
+    else:
+        data_utils.parallel_extract(extract_tile, tasks, save_dir, n_workers)
 
 
 def get_stats(img_dir):
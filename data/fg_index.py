@@ -0,0 +1,168 @@
+"""
+Foreground index of a set of label files, the #pixels of each class and the bounding boxes of the connected components
+of each label are computed once in a parallel pass and stored in a single npz file, so sampling, stratification and
+class distribution reports don't need to read the labels again
+The index has the following arrays:
+    files: the label files
+    shapes: height and width of each label (n*2)
+    counts: #pixels of each class in each label (n*n_class)
+    boxes: one row for each connected component, file id, class id, y_min, x_min, y_max, x_max and #pixels, the max
+           coordinates are exclusive
+    signature: size and mtime of the label files and the parameters of the index, the index is rebuilt if it changes
+"""
+
+
+# Built-in
+import os
+import json
+from multiprocessing import Pool
+
+# Libs
+import numpy as np
+from tqdm import tqdm
+
+# Own modules
+from mrs_utils import misc_utils
+
+
+def _index_label(args):
+    """
+    Compute the class counts and the component bounding boxes of one label
+    :param args: tuple of the label file, the file id, the min #classes, the label function and whether to find boxes
+    :return: the shape of the label, the class counts and the boxes
+    """
+    lbl_file, file_id, n_class, lbl_func, with_boxes = args
+    lbl = misc_utils.load_file(lbl_file)
+    if lbl_func is not None:
+        lbl = lbl_func(lbl)
+    lbl = lbl.astype(np.int64, copy=False)
+    counts = np.bincount(lbl.ravel(), minlength=n_class)
+    boxes = []
+    if with_boxes:
+        from scipy import ndimage
+        for class_id in np.nonzero(counts)[0]:
+            if class_id == 0:
+                continue
+            components, n_comp = ndimage.label(lbl == class_id)
+            areas = np.bincount(components.ravel(), minlength=n_comp + 1)[1:]
+            for (slice_y, slice_x), area in zip(ndimage.find_objects(components), areas):
+                boxes.append((file_id, class_id, slice_y.start, slice_x.start, slice_y.stop, slice_x.stop, area))
+    return lbl.shape[:2], counts, np.array(boxes, dtype=np.int64).reshape((-1, 7))
+
+
+def build_index(lbl_files, index_file, n_class=2, lbl_func=None, with_boxes=True, n_workers=0, force_run=False):
+    """
+    Build the foreground index of the label files, the index is only built again if the label files or the parameters
+    have changed
+    :param lbl_files: list of label files
+    :param index_file: path to the npz file to save the index
+    :param n_class: min #classes, the counts will have more columns if a label has larger class ids
+    :param lbl_func: function applied to the labels before indexing, e.g. data_utils.scale_label or the decode_map of
+                     the dataset, it needs to be a module level function when n_workers > 1
+    :param with_boxes: if True, the bounding boxes of the connected components of each non-zero class are recorded
+    :param n_workers: #processes to index the labels in parallel
+    :param force_run: if True, the index is always built again
+    :return: the ForegroundIndex
+    """
+    params = [n_class, None if lbl_func is None else '{}.{}'.format(lbl_func.__module__, lbl_func.__name__),
+              with_boxes]
+    signature = json.dumps(misc_utils.get_tile_signature(lbl_files, params), sort_keys=True)
+    if not force_run and os.path.exists(index_file):
+        index = ForegroundIndex(index_file)
+        if index.signature == signature:
+            return index
+
+    jobs = [(lbl_file, file_id, n_class, lbl_func, with_boxes) for file_id, lbl_file in enumerate(lbl_files)]
+    if n_workers > 1:
+        with Pool(n_workers) as pool:
+            results = list(tqdm(pool.imap(_index_label, jobs, chunksize=16), total=len(jobs), desc='Index'))
+    else:
+        results = [_index_label(job) for job in tqdm(jobs, desc='Index')]
+    n_col = max([n_class] + [len(counts) for _, counts, _ in results])
+    counts = np.zeros((len(results), n_col), dtype=np.int64)
+    for cnt, (_, lbl_counts, _) in enumerate(results):
+        counts[cnt, :len(lbl_counts)] = lbl_counts
+    shapes = np.array([shape for shape, _, _ in results], dtype=np.int64).reshape((-1, 2))
+    boxes = np.concatenate([np.zeros((0, 7), dtype=np.int64)] + [lbl_boxes for _, _, lbl_boxes in results], axis=0)
+
+    misc_utils.make_dir_if_not_exist(os.path.dirname(os.path.abspath(index_file)))
+    tmp_file = '{}.tmp.npz'.format(os.path.splitext(index_file)[0])
+    np.savez(tmp_file, files=np.array(lbl_files, dtype=str), shapes=shapes, counts=counts, boxes=boxes,
+             signature=np.array(signature))
+    os.replace(tmp_file, index_file)
+    return ForegroundIndex(index_file)
+
+
+class ForegroundIndex(object):
+    def __init__(self, index_file):
+        """
+        Query the foreground index made by build_index()
+        :param index_file: path to the npz file of the index
+        """
+        with np.load(index_file) as index:
+            self.files = [str(a) for a in index['files']]
+            self.shapes = index['shapes']
+            self.counts = index['counts']
+            self.boxes = index['boxes']
+            self.signature = str(index['signature'])
+
+    def __len__(self):
+        return len(self.files)
+
+    def class_distribution(self):
+        """
+        Get the #pixels of each class over all the labels
+        :return: array of the #pixels of each class
+        """
+        return np.sum(self.counts, axis=0)
+
+    def get_fg_fractions(self, classes=None):
+        """
+        Get the fraction of foreground pixels of each label
+        :param classes: the foreground classes, if None, all the non-zero classes are foreground
+        :return: array of the foreground fraction of each label
+        """
+        n_pixels = np.prod(self.shapes, axis=1)
+        if classes is None:
+            n_fg = n_pixels - self.counts[:, 0]
+        else:
+            n_fg = np.sum(self.counts[:, list(classes)], axis=1)
+        return n_fg / np.maximum(n_pixels, 1)
+
+    def query(self, min_fraction=0, max_fraction=1, classes=None):
+        """
+        Get the labels whose foreground fraction is within the given range
+        :param min_fraction: the foreground fraction should be greater than this
+        :param max_fraction: the foreground fraction should be no greater than this
+        :param classes: the foreground classes, if None, all the non-zero classes are foreground
+        :return: array of the ids of the labels, use self.files to get their paths
+        """
+        fractions = self.get_fg_fractions(classes)
+        return np.where((fractions > min_fraction) & (fractions <= max_fraction))[0]
+
+    def stratify(self, n_bins=4, classes=None):
+        """
+        Assign the labels into strata of equal size by their foreground fraction, e.g. to make a density stratified
+        train/valid split
+        :param n_bins: #strata
+        :param classes: the foreground classes, if None, all the non-zero classes are foreground
+        :return: array of the stratum of each label, 0 is the sparsest
+        """
+        fractions = self.get_fg_fractions(classes)
+        edges = np.quantile(fractions, np.linspace(0, 1, n_bins + 1)[1:-1])
+        return np.searchsorted(edges, fractions, side='right')
+
+    def get_boxes(self, file_id=None, class_id=None, min_area=0):
+        """
+        Get the bounding boxes of the connected components
+        :param file_id: id of the label, if None, boxes of all the labels are returned
+        :param class_id: id of the class, if None, boxes of all the classes are returned
+        :param min_area: min #pixels of the components
+        :return: array of the boxes, each row is file id, class id, y_min, x_min, y_max, x_max and #pixels
+        """
+        keep = self.boxes[:, 6] >= min_area
+        if file_id is not None:
+            keep &= self.boxes[:, 0] == file_id
+        if class_id is not None:
+            keep &= self.boxes[:, 1] == class_id
+        return self.boxes[keep]
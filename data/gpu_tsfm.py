@@ -0,0 +1,116 @@
+"""
+Batch augmentation on the GPU, this is the counterpart of the albumentations transforms made by
+network_io.create_tsfm(), the data loader workers only decode the patches into uint8 tensors and the crop, flip, rot90
+and normalization are applied to the whole batch on the device after collation, the random parameters are drawn for
+each sample and the image and the mask get the same ones
+"""
+
+
+# Pytorch
+import torch
+import torch.nn.functional as F
+
+
+class GPUTransform(object):
+    def __init__(self, mean, std, crop_size=None, crop_mode=None, flip=True, rot90=True, normalize=True,
+                 scale=(0.08, 1.0), ratio=(3 / 4, 4 / 3)):
+        """
+        Make the batch transform
+        :param mean: mean of the dataset, in the range of 0 to 1 like albumentations.Normalize
+        :param std: std of the dataset, in the range of 0 to 1 like albumentations.Normalize
+        :param crop_size: size of the output patches, should be a tuple of (h, w)
+        :param crop_mode: None to keep the patches as they are, crop for RandomCrop or resized_crop for RandomResizedCrop
+        :param flip: if True, each sample is flipped horizontally, vertically or both with a probability of 0.5
+        :param rot90: if True, each sample is rotated by a random multiple of 90 degrees with a probability of 0.5, the
+                      patches need to be square
+        :param normalize: if True, the images are scaled to 0~1 and normalized by the mean and std
+        :param scale: range of the area of the crop relative to the patch for resized_crop
+        :param ratio: range of the aspect ratio of the crop for resized_crop
+        """
+        self.mean = torch.tensor(mean, dtype=torch.float).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float).view(1, -1, 1, 1)
+        self.crop_size = crop_size
+        self.crop_mode = crop_mode
+        self.flip = flip
+        self.rot90 = rot90
+        self.normalize = normalize
+        self.scale = scale
+        self.ratio = ratio
+
+    def random_crop(self, image, mask):
+        n, _, h, w = image.shape
+        ys = torch.randint(0, h - self.crop_size[0] + 1, (n,)).tolist()
+        xs = torch.randint(0, w - self.crop_size[1] + 1, (n,)).tolist()
+        image = torch.stack([image[i, :, y:y + self.crop_size[0], x:x + self.crop_size[1]]
+                             for i, (y, x) in enumerate(zip(ys, xs))], dim=0)
+        mask = torch.stack([mask[i, y:y + self.crop_size[0], x:x + self.crop_size[1]]
+                            for i, (y, x) in enumerate(zip(ys, xs))], dim=0)
+        return image, mask
+
+    def random_resized_crop(self, image, mask):
+        n, _, h, w = image.shape
+        area = h * w * torch.empty(n).uniform_(*self.scale)
+        log_ratio = torch.empty(n).uniform_(torch.log(torch.tensor(self.ratio[0])).item(),
+                                            torch.log(torch.tensor(self.ratio[1])).item())
+        aspect = torch.exp(log_ratio)
+        crop_h = torch.clamp(torch.sqrt(area / aspect).round(), 1, h).long()
+        crop_w = torch.clamp(torch.sqrt(area * aspect).round(), 1, w).long()
+        images, masks = [], []
+        for i in range(n):
+            ch, cw = crop_h[i].item(), crop_w[i].item()
+            y = torch.randint(0, h - ch + 1, (1,)).item()
+            x = torch.randint(0, w - cw + 1, (1,)).item()
+            images.append(F.interpolate(image[i:i + 1, :, y:y + ch, x:x + cw], size=self.crop_size, mode='bilinear',
+                                        align_corners=False))
+            masks.append(F.interpolate(mask[i:i + 1, None, y:y + ch, x:x + cw].float(), size=self.crop_size,
+                                       mode='nearest')[:, 0].to(mask.dtype))
+        return torch.cat(images, dim=0), torch.cat(masks, dim=0)
+
+    @staticmethod
+    def select(cond, x, y):
+        return torch.where(cond.view(-1, *([1] * (x.dim() - 1))), x, y)
+
+    def random_flip(self, image, mask):
+        n = image.shape[0]
+        do_flip = torch.rand(n, device=image.device) < 0.5
+        # 0: vertical, 1: horizontal, 2: both, the same as albumentations.Flip
+        mode = torch.randint(0, 3, (n,), device=image.device)
+        flip_v = do_flip & (mode != 1)
+        flip_h = do_flip & (mode != 0)
+        image = self.select(flip_v, image.flip(-2), image)
+        mask = self.select(flip_v, mask.flip(-2), mask)
+        image = self.select(flip_h, image.flip(-1), image)
+        mask = self.select(flip_h, mask.flip(-1), mask)
+        return image, mask
+
+    def random_rot90(self, image, mask):
+        n = image.shape[0]
+        k = torch.randint(0, 4, (n,), device=image.device)
+        k = torch.where(torch.rand(n, device=image.device) < 0.5, k, torch.zeros_like(k))
+        rot_image, rot_mask = image, mask
+        for cnt in range(1, 4):
+            rot_image = torch.rot90(rot_image, 1, dims=(-2, -1))
+            rot_mask = torch.rot90(rot_mask, 1, dims=(-2, -1))
+            image = self.select(k == cnt, rot_image, image)
+            mask = self.select(k == cnt, rot_mask, mask)
+        return image, mask
+
+    def __call__(self, image, mask):
+        """
+        Augment a batch
+        :param image: batch of images of n*c*h*w, usually uint8 from albumentations.pytorch.ToTensorV2
+        :param mask: batch of masks of n*h*w
+        :return: the augmented float images and the masks
+        """
+        image = image.float()
+        if self.crop_mode == 'crop':
+            image, mask = self.random_crop(image, mask)
+        elif self.crop_mode == 'resized_crop':
+            image, mask = self.random_resized_crop(image, mask)
+        if self.flip:
+            image, mask = self.random_flip(image, mask)
+        if self.rot90 and image.shape[-2] == image.shape[-1]:
+            image, mask = self.random_rot90(image, mask)
+        if self.normalize:
+            image = (image / 255 - self.mean.to(image.device)) / self.std.to(image.device)
+        return image.contiguous(), mask.contiguous()
@@ -9,7 +9,6 @@ import os
 # Libs
 import h5py
 import numpy as np
-from tqdm import tqdm
 
 # Own modules
 from data import data_utils
@@ -25,9 +24,23 @@ VAL_CITY = ['austin', 'chicago', 'kitsap', 'tyrol-w', 'vienna']
 VAL_IDS = list(range(1, 6))
 MEAN = (0.41776216, 0.43993309, 0.39138562)
 STD = (0.18476704, 0.16793099, 0.15915148)
+# patches that are mostly no-data (black) are dropped, set min_fg to also drop the patches without buildings
+PATCH_FILTER = {'max_blank': 0.5, 'min_fg': None, 'nodata_val': 0}
 
 
-def patch_inria(data_dir, save_dir, patch_size, pad, overlap):
+def extract_tile(rgb_file, gt_file, patch_dir, prefix, patch_size, pad, overlap, codec='jpg', quality=None,
+                 patch_filter=None):
+    """
+    Extract one inria tile into patches, the labels are scaled from 255 to 1
+    :return: records in the file list and #patches rejected by the patch filter
+    """
+    return data_utils.extract_tile(rgb_file, gt_file, patch_dir, prefix, patch_size, pad, overlap,
+                                   lbl_func=data_utils.scale_label, codec=codec, quality=quality,
+                                   patch_filter=patch_filter)
+
+
+def patch_inria(data_dir, save_dir, patch_size, pad, overlap, n_workers=0, pack=None, codec='jpg', quality=None,
+                patch_filter=PATCH_FILTER):
     """
     Preprocess the standard inria dataset
     :param data_dir: path to the original inria dataset
@@ -35,29 +48,36 @@ def patch_inria(data_dir, save_dir, patch_size, pad, overlap):
     :param patch_size: size of the patches, should be a tuple of (h, w)
     :param pad: #pixels to be padded around each tile, should be either one element or four elements
     :param overlap: #overlapping pixels between two patches in both vertical and horizontal direction
+    :param n_workers: #processes to extract the tiles in parallel
+    :param pack: if hdf5 or zarr, the patches will be packed into {split}.hdf5 or {split}.zarr without patch files
+    :param codec: format of the image patches, npy, png, jpg or webp, see data_utils.get_patch_codec()
+    :param quality: quality of the lossy formats, if None, the PIL default will be used
+    :param patch_filter: thresholds to drop the blank and empty patches, see data_utils.filter_patches(), if None,
+                         every patch is kept
     :return:
     """
     # create folders and files
     patch_dir = os.path.join(save_dir, 'patches')
     misc_utils.make_dir_if_not_exist(patch_dir)
-    record_file_train = open(os.path.join(save_dir, 'file_list_train.txt'), 'w+')
-    record_file_valid = open(os.path.join(save_dir, 'file_list_valid.txt'), 'w+')
     # get rgb and gt files
-    for city_name in tqdm(SAVE_CITY, desc='City-wise'):
-        for tile_id in tqdm(range(1, 37), desc='Tile-wise', leave=False):
+    tasks = []
+    for city_name in SAVE_CITY:
+        for tile_id in range(1, 37):
             rgb_filename = os.path.join(data_dir, 'images', '{}{}.tif'.format(city_name, tile_id))
             gt_filename = os.path.join(data_dir, 'gt', '{}{}.tif'.format(city_name, tile_id))
-            for rgb_patch, gt_patch, y, x in data_utils.patch_tile(rgb_filename, gt_filename, patch_size, pad, overlap):
-                rgb_patchname = '{}{}_y{}x{}.jpg'.format(city_name, tile_id, int(y), int(x))
-                gt_patchname = '{}{}_y{}x{}.png'.format(city_name, tile_id, int(y), int(x))
-                misc_utils.save_file(os.path.join(patch_dir, rgb_patchname), rgb_patch.astype(np.uint8))
-                misc_utils.save_file(os.path.join(patch_dir, gt_patchname), (gt_patch/255).astype(np.uint8))
-                if city_name in VAL_CITY and tile_id in VAL_IDS:
-                    record_file_valid.write('{} {}\n'.format(rgb_patchname, gt_patchname))
-                else:
-                    record_file_train.write('{} {}\n'.format(rgb_patchname, gt_patchname))
-    record_file_train.close()
-    record_file_valid.close()
+            if city_name in VAL_CITY and tile_id in VAL_IDS:
+                split = 'valid'
+            else:
+                split = 'train'
+            tasks.append((split, (rgb_filename, gt_filename, patch_dir, '{}{}'.format(city_name, tile_id),
+                                  patch_size, pad, overlap, codec, quality, patch_filter)))
+    if pack:
+        # cut the patches straight into array stores instead of patch files
+        data_utils.pack_tiles([(split, (args[0], args[1], args[3])) for split, args in tasks], save_dir, patch_size,
+                              pad, overlap, lbl_func=data_utils.scale_label, backend=pack, n_workers=n_workers,
+                              patch_filter=patch_filter)
+    else:
+        data_utils.parallel_extract(extract_tile, tasks, save_dir, n_workers)
 
 
 def get_stats(img_dir):
@@ -8,7 +8,6 @@ import os
 
 # Libs
 import numpy as np
-from tqdm import tqdm
 
 # Own modules
 from data import data_utils
@@ -23,9 +22,11 @@ SPLITS = ['train', 'valid']
 MODES = os.listdir(os.path.join(DATA_DIR, SPLITS[0]))
 MEAN = (0.4251811, 0.42812928, 0.39143909)
 STD = (0.22423858, 0.21664895, 0.22102307)
+# the tiles have white no-data regions outside the imaged area, see data_utils.filter_patches()
+PATCH_FILTER = {'max_blank': 0.5, 'min_fg': None, 'nodata_val': 255}
 
 
-def patch_tile(rgb_file, gt_file, patch_size, pad, overlap):
+def patch_tile(rgb_file, gt_file, patch_size, pad, overlap, patch_filter=None, stats=None):
     """
     Extract the given rgb and gt tiles into patches
     :param rgb_file: path to the rgb file
@@ -33,25 +34,26 @@ def patch_tile(rgb_file, gt_file, patch_size, pad, overlap):
     :param patch_size: size of the patches, should be a tuple of (h, w)
     :param pad: #pixels to be padded around each tile, should be either one element or four elements
     :param overlap: #overlapping pixels between two patches in both vertical and horizontal direction
+    :param patch_filter: thresholds to drop the blank and empty patches, see data_utils.filter_patches()
+    :param stats: dictionary to accumulate the #patches rejected by the patch filter into
     :return: rgb and gt patches as well as coordinates
     """
-    rgb = misc_utils.load_file(rgb_file)
-    gt = misc_utils.load_file(gt_file)
-    np.testing.assert_array_equal(rgb.shape[:2], gt.shape)
-    grid_list = data_utils.make_grid(
-        np.array(rgb.shape[:2]) + 2 * pad, patch_size, overlap)
-    if pad > 0:
-        rgb = data_utils.pad_image(rgb, pad)
-        gt = data_utils.pad_image(gt, pad)
-    for y, x in grid_list:
-        rgb_patch = data_utils.crop_image(
-            rgb, y, x, patch_size[0], patch_size[1])
-        gt_patch = data_utils.crop_image(
-            gt, y, x, patch_size[0], patch_size[1])
-        yield rgb_patch, gt_patch, y, x
-
-
-def patch_mnih(data_dir, save_dir, patch_size, pad, overlap):
+    return data_utils.patch_tile(rgb_file, gt_file, patch_size, pad, overlap, patch_filter, stats)
+
+
+def extract_tile(rgb_file, gt_file, patch_dir, prefix, patch_size, pad, overlap, codec='jpg', quality=None,
+                 patch_filter=None):
+    """
+    Extract one mnih tile into patches, the labels are scaled from 255 to 1
+    :return: records in the file list and #patches rejected by the patch filter
+    """
+    return data_utils.extract_tile(rgb_file, gt_file, patch_dir, prefix, patch_size, pad, overlap,
+                                   tile_func=patch_tile, lbl_func=data_utils.scale_label, codec=codec,
+                                   quality=quality, patch_filter=patch_filter)
+
+
+def patch_mnih(data_dir, save_dir, patch_size, pad, overlap, n_workers=0, pack=None, codec='jpg', quality=None,
+               patch_filter=PATCH_FILTER):
     """
     Preprocess the standard mnih dataset
     :param data_dir: path to the original mnih dataset
@@ -59,34 +61,36 @@ def patch_mnih(data_dir, save_dir, patch_size, pad, overlap):
     :param patch_size: size of the patches, should be a tuple of (h, w)
     :param pad: #pixels to be padded around each tile, should be either one element or four elements
     :param overlap: #overlapping pixels between two patches in both vertical and horizontal direction
+    :param n_workers: #processes to extract the tiles in parallel
+    :param pack: if hdf5 or zarr, the patches will be packed into {split}.hdf5 or {split}.zarr without patch files
+    :param codec: format of the image patches, npy, png, jpg or webp, see data_utils.get_patch_codec()
+    :param quality: quality of the lossy formats, if None, the PIL default will be used
+    :param patch_filter: thresholds to drop the blank and empty patches, see data_utils.filter_patches(), if None,
+                         every patch is kept
     :return:
     """
-
-    for dataset in tqdm(SPLITS, desc='Train-valid split'):
-        FILENAMES = [
-            fname.split('.')[0] for fname in os.listdir(os.path.join(DATA_DIR, dataset, MODES[0]))
-        ]
-        # create folders and files
-        patch_dir = os.path.join(save_dir, 'patches')
-        misc_utils.make_dir_if_not_exist(patch_dir)
-        record_file = open(os.path.join(
-            save_dir, 'file_list_{}.txt'.format(dataset)), 'w+')
-
-        # get rgb and gt files
-        for fname in tqdm(FILENAMES, desc='File-wise'):
-            rgb_filename = os.path.join(
-                DATA_DIR, dataset, 'sat', fname+'.tiff')
-            gt_filename = os.path.join(DATA_DIR, dataset, 'map', fname+'.tif')
-            for rgb_patch, gt_patch, y, x in patch_tile(rgb_filename, gt_filename, patch_size, pad, overlap):
-                rgb_patchname = '{}_y{}x{}.jpg'.format(fname, int(y), int(x))
-                gt_patchname = '{}_y{}x{}.png'.format(fname, int(y), int(x))
-                misc_utils.save_file(os.path.join(
-                    patch_dir, rgb_patchname), rgb_patch.astype(np.uint8))
-                misc_utils.save_file(os.path.join(
-                    patch_dir, gt_patchname), (gt_patch/255).astype(np.uint8))
-                record_file.write('{} {}\n'.format(
-                    rgb_patchname, gt_patchname))
-        record_file.close()
+    # create folders and files
+    patch_dir = os.path.join(save_dir, 'patches')
+    misc_utils.make_dir_if_not_exist(patch_dir)
+
+    # get rgb and gt files
+    tasks = []
+    for dataset in SPLITS:
+        file_names = sorted([
+            fname.split('.')[0] for fname in os.listdir(os.path.join(data_dir, dataset, MODES[0]))
+        ])
+        for fname in file_names:
+            rgb_filename = os.path.join(data_dir, dataset, 'sat', fname+'.tiff')
+            gt_filename = os.path.join(data_dir, dataset, 'map', fname+'.tif')
+            tasks.append((dataset, (rgb_filename, gt_filename, patch_dir, fname, patch_size, pad, overlap, codec,
+                                    quality, patch_filter)))
+    if pack:
+        # cut the patches straight into array stores instead of patch files
+        data_utils.pack_tiles([(split, (args[0], args[1], args[3])) for split, args in tasks], save_dir, patch_size,
+                              pad, overlap, tile_func=patch_tile, lbl_func=data_utils.scale_label,
+                              backend=pack, n_workers=n_workers, patch_filter=patch_filter)
+    else:
+        data_utils.parallel_extract(extract_tile, tasks, save_dir, n_workers, splits=SPLITS)
 
 
 def get_images(data_dir=DATA_DIR, dataset='test'):
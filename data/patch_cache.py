@@ -0,0 +1,111 @@
+"""
+Decoded patch cache shared by the data loader workers, the decoded arrays are kept in fixed size slots of memory-mapped
+files (in /dev/shm by default, so they live in shared memory, or on a local disk), the cache is filled lazily by the
+first epoch and read by all the workers afterwards
+The cache has to be created in the main process before the workers are started, the workers inherit the mappings and
+the shared metadata when they are forked (the default on Linux)
+Writers take a lock to pick a slot, the least recently used slot is evicted when the cache is full. Readers don't take
+the lock, every slot has a version number that is odd while the slot is being written, a reader copies the slot and
+checks the version did not change in between, otherwise it is treated as a miss (seqlock)
+"""
+
+
+# Built-in
+import os
+import warnings
+import tempfile
+import multiprocessing
+
+# Libs
+import numpy as np
+
+
+class PatchCache(object):
+    def __init__(self, n_items, shapes, dtypes, cache_bytes, cache_dir=None):
+        """
+        Make an empty cache
+        :param n_items: #items in the dataset, items are identified by their index
+        :param shapes: list of shapes of the arrays of each item, e.g. the shapes of the image and the label patches
+        :param dtypes: list of data types of the arrays of each item
+        :param cache_bytes: byte budget of the cache, it decides the #slots
+        :param cache_dir: directory of the memory-mapped files, if None, /dev/shm is used when it exists
+        """
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.dtypes = [np.dtype(dtype) for dtype in dtypes]
+        slot_bytes = sum([int(np.prod(shape)) * dtype.itemsize for shape, dtype in zip(self.shapes, self.dtypes)])
+        if cache_dir is None and os.path.isdir('/dev/shm'):
+            cache_dir = '/dev/shm'
+        # the files are sparse, writing past the free space of the file system kills the workers with SIGBUS, e.g.
+        # docker only gives 64MB of /dev/shm by default
+        stat = os.statvfs(cache_dir if cache_dir is not None else tempfile.gettempdir())
+        free_bytes = stat.f_bavail * stat.f_frsize
+        if cache_bytes > free_bytes:
+            warnings.warn('Patch cache of {:.2f}GB does not fit into the {:.2f}GB free space of {}, it is reduced to '
+                          'the free space'.format(cache_bytes / 1024 ** 3, free_bytes / 1024 ** 3, cache_dir))
+            cache_bytes = free_bytes
+        self.n_slots = int(min(cache_bytes // slot_bytes, n_items))
+        # the files are removed right after they are mapped, the mappings stay valid and are freed with the processes
+        self.arrays = []
+        for shape, dtype in zip(self.shapes, self.dtypes):
+            fd, file_name = tempfile.mkstemp(suffix='.cache', dir=cache_dir)
+            os.close(fd)
+            self.arrays.append(np.memmap(file_name, dtype=dtype, mode='w+', shape=(max(self.n_slots, 1), *shape)))
+            os.remove(file_name)
+        self.lock = multiprocessing.Lock()
+        self.item_slot = multiprocessing.Array('q', [-1] * n_items, lock=False)
+        self.slot_item = multiprocessing.Array('q', [-1] * max(self.n_slots, 1), lock=False)
+        self.slot_tick = multiprocessing.Array('q', [0] * max(self.n_slots, 1), lock=False)
+        self.slot_version = multiprocessing.Array('q', [0] * max(self.n_slots, 1), lock=False)
+        self.tick = multiprocessing.Value('q', 0, lock=False)
+
+    def __len__(self):
+        return self.n_slots
+
+    def get(self, index):
+        """
+        Read an item from the cache
+        :param index: index of the item
+        :return: list of copies of the arrays of the item, or None if the item is not cached
+        """
+        slot = self.item_slot[index]
+        if slot < 0:
+            return None
+        version = self.slot_version[slot]
+        if version % 2 == 1 or self.slot_item[slot] != index:
+            return None
+        # the slot is copied out on purpose: it could be evicted and overwritten by another worker at any time, the
+        # version check only proves the copy is consistent, a view could change under the transforms or the collate
+        arrays = [np.array(array[slot]) for array in self.arrays]
+        if self.slot_version[slot] != version:
+            return None
+        self.tick.value += 1
+        self.slot_tick[slot] = self.tick.value
+        return arrays
+
+    def put(self, index, arrays):
+        """
+        Write an item into the cache, the least recently used item is evicted if the cache is full, items whose arrays
+        don't match the shapes or data types of the cache are not cached
+        :param index: index of the item
+        :param arrays: list of arrays of the item
+        :return:
+        """
+        if self.n_slots == 0 or self.item_slot[index] >= 0:
+            return
+        for array, shape, dtype in zip(arrays, self.shapes, self.dtypes):
+            if array.shape != shape or array.dtype != dtype:
+                return
+        with self.lock:
+            if self.item_slot[index] >= 0:
+                return
+            slot = int(np.argmin(np.frombuffer(self.slot_tick, dtype=np.int64)))
+            self.slot_version[slot] += 1
+            if self.slot_item[slot] >= 0:
+                self.item_slot[self.slot_item[slot]] = -1
+            self.slot_item[slot] = index
+            for cache_array, array in zip(self.arrays, arrays):
+                cache_array[slot] = array
+            self.tick.value += 1
+            self.slot_tick[slot] = self.tick.value
+            self.item_slot[index] = slot
+            self.slot_version[slot] += 1
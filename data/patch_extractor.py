@@ -10,13 +10,17 @@ import os
 import numpy as np
 from tqdm import tqdm
 
+# PyTorch
+import torch
+
 # Own modules
 from mrs_utils import misc_utils
 
 
 def pad_image(img, pad, mode='reflect'):
     """
-    Symmetric pad pixels around images
+    Symmetric pad pixels around images, the data type of the image is preserved and all the channels are padded in
+    one call
     :param img: image to pad
     :param pad: list of #pixels pad around the image, if it is a scalar, it will be assumed to pad same number
                 number of pixels around 4 directions
@@ -26,19 +30,16 @@ def pad_image(img, pad, mode='reflect'):
     if type(pad) is not list:
         pad = [pad for i in range(4)]
     assert len(pad) == 4
-    if len(img.shape) == 2:
-        return np.pad(img, ((pad[0], pad[1]), (pad[2], pad[3])), mode)
-    else:
-        h, w, c = img.shape
-        pad_img = np.zeros((h + pad[0] + pad[1], w + pad[2] + pad[3], c))
-        for i in range(c):
-            pad_img[:, :, i] = np.pad(img[:, :, i], ((pad[0], pad[1]), (pad[2], pad[3])), mode)
-    return pad_img
+    if not any(pad):
+        return img
+    pad_width = ((pad[0], pad[1]), (pad[2], pad[3])) + ((0, 0), ) * (len(img.shape) - 2)
+    return np.pad(img, pad_width, mode)
 
 
 def crop_image(img, y, x, h, w):
     """
     Crop the image with given top-left anchor and corresponding width & height
+    The patch is a view of the image, no data is copied
     :param img: image to be cropped
     :param y: height of anchor
     :param x: width of anchor
@@ -46,10 +47,7 @@ def crop_image(img, y, x, h, w):
     :param w: width of the patch
     :return:
     """
-    if len(img.shape) == 2:
-        return img[y:y+w, x:x+h]
-    else:
-        return img[y:y+w, x:x+h, :]
+    return img[y:y+h, x:x+w, ...]
 
 
 def make_grid(tile_size, patch_size, overlap):
@@ -97,6 +95,115 @@ def patch_block(block, pad, grid_list, patch_size, return_coord=False):
             yield patch
 
 
+class PatchStitcher(object):
+    def __init__(self, tile_dim, patch_size, tile_dim_output=None, patch_size_output=None, overlap=0, grid_list=None,
+                 dtype=np.float32):
+        """
+        Streaming version of unpatch_block(): each patch is accumulated into a preallocated canvas as soon as it is
+        added, so that the patches never need to be held in memory all together
+        Patches are expected to be added in the same order as the grid list
+        :param tile_dim: input tile dimension, if padding exits should be h+2*pad, w+2*pad
+        :param patch_size: input patch size
+        :param tile_dim_output: output tile dimension
+        :param patch_size_output: output patch dimension, if shrinking exits, should be h-2*pad, w-2*pad
+        :param overlap: overlap of adjacent patches
+        :param grid_list: list of grids, if None, it will be computed by make_grid(tile_dim, patch_size, overlap)
+        :param dtype: data type of the canvas, float32 or float16
+        """
+        if tile_dim_output is None:
+            tile_dim_output = tile_dim
+        if patch_size_output is None:
+            patch_size_output = patch_size
+        if grid_list is None:
+            grid_list = make_grid(tile_dim, patch_size, overlap)
+        self.tile_dim_output = tile_dim_output
+        self.patch_size_output = patch_size_output
+        self.grid_list = grid_list
+        self.dtype = dtype
+        self.image = None
+        # one weight map shared by all channels
+        self.weight = np.zeros((tile_dim_output[0], tile_dim_output[1]), dtype=np.float32)
+        self.patch_cnt = 0
+
+    def add(self, patch):
+        """
+        Accumulate one patch into the canvas
+        :param patch: the patch to be added, should be h*w*c
+        :return:
+        """
+        if self.image is None:
+            self.image = np.zeros((self.tile_dim_output[0], self.tile_dim_output[1], patch.shape[-1]), dtype=self.dtype)
+        corner_h, corner_w = self.grid_list[self.patch_cnt]
+        self.image[corner_h:corner_h + self.patch_size_output[0], corner_w:corner_w + self.patch_size_output[1], :] \
+            += patch
+        self.weight[corner_h:corner_h + self.patch_size_output[0], corner_w:corner_w + self.patch_size_output[1]] += 1
+        self.patch_cnt += 1
+
+    def add_batch(self, patches):
+        """
+        Accumulate a batch of patches into the canvas
+        :param patches: list of patches or n*h*w*c array
+        :return:
+        """
+        for patch in patches:
+            self.add(patch)
+
+    def get_tile(self):
+        """
+        Normalize the canvas by the weight map, this is done in place so no extra copy of the tile is made
+        :return: the stitched tile
+        """
+        assert self.patch_cnt == len(self.grid_list)
+        self.image /= self.weight[:, :, np.newaxis].astype(self.dtype)
+        return self.image
+
+
+class TorchPatchStitcher(PatchStitcher):
+    def __init__(self, tile_dim, patch_size, tile_dim_output=None, patch_size_output=None, overlap=0, grid_list=None,
+                 dtype=torch.float32, device=None):
+        """
+        Same as PatchStitcher but the canvas lives on the given torch device as a c*h*w tensor, patches are overlap
+        added with indexed adds so the predictions never leave the device
+        :param tile_dim: input tile dimension, if padding exits should be h+2*pad, w+2*pad
+        :param patch_size: input patch size
+        :param tile_dim_output: output tile dimension
+        :param patch_size_output: output patch dimension, if shrinking exits, should be h-2*pad, w-2*pad
+        :param overlap: overlap of adjacent patches
+        :param grid_list: list of grids, if None, it will be computed by make_grid(tile_dim, patch_size, overlap)
+        :param dtype: torch data type of the canvas, torch.float32 or torch.float16
+        :param device: the device where the canvas is allocated
+        """
+        super(TorchPatchStitcher, self).__init__(tile_dim, patch_size, tile_dim_output, patch_size_output, overlap,
+                                                 grid_list, dtype)
+        self.device = device
+        self.weight = torch.zeros((self.tile_dim_output[0], self.tile_dim_output[1]), dtype=torch.float32,
+                                  device=device)
+
+    def add(self, patch):
+        """
+        Accumulate one patch into the canvas
+        :param patch: the patch tensor to be added, should be c*h*w
+        :return:
+        """
+        if self.image is None:
+            self.image = torch.zeros((patch.shape[0], self.tile_dim_output[0], self.tile_dim_output[1]),
+                                     dtype=self.dtype, device=self.device)
+        corner_h, corner_w = self.grid_list[self.patch_cnt]
+        self.image[:, corner_h:corner_h + self.patch_size_output[0], corner_w:corner_w + self.patch_size_output[1]] \
+            += patch.to(self.dtype)
+        self.weight[corner_h:corner_h + self.patch_size_output[0], corner_w:corner_w + self.patch_size_output[1]] += 1
+        self.patch_cnt += 1
+
+    def get_tile(self):
+        """
+        Normalize the canvas by the weight map in place
+        :return: the stitched c*h*w tensor, still on the device
+        """
+        assert self.patch_cnt == len(self.grid_list)
+        self.image /= self.weight.unsqueeze(0).to(self.dtype)
+        return self.image
+
+
 def unpatch_block(blocks, tile_dim, patch_size, tile_dim_output=None, patch_size_output=None, overlap=0):
     """
     Unpatch a block, set tile_dim_output and patch_size_output to a proper number if padding exits
@@ -108,86 +215,77 @@ def unpatch_block(blocks, tile_dim, patch_size, tile_dim_output=None, patch_size
     :param overlap: overlap of adjacent patches
     :return:
     """
-    if tile_dim_output is None:
-        tile_dim_output = tile_dim
-    if patch_size_output is None:
-        patch_size_output = patch_size
-    _, _, _, c = blocks.shape
-    image = np.zeros((tile_dim_output[0], tile_dim_output[1], c))
-    image_cnt = np.zeros_like(image)
-    for cnt, (corner_h, corner_w) in enumerate(make_grid(tile_dim, patch_size, overlap)):
-        image[corner_h:corner_h + patch_size_output[0], corner_w:corner_w + patch_size_output[1], :] \
-            += blocks[cnt, :, :, :]
-        image_cnt[corner_h:corner_h + patch_size_output[0], corner_w:corner_w + patch_size_output[1], :] \
-            += np.ones_like(blocks[cnt, :, :, :])
-    return image / image_cnt
-
-
-def patch_extractor(file_list, file_exts, patch_size, pad, overlap, save_path, force_run=False):
+    stitcher = PatchStitcher(tile_dim, patch_size, tile_dim_output, patch_size_output, overlap, dtype=np.float64)
+    stitcher.add_batch(blocks)
+    return stitcher.get_tile()
+
+
+def patch_extractor(file_list, file_exts, patch_size, pad, overlap, save_path, force_run=False, patch_filter=None):
     """
     Extract the patches
+    Every row of files has its own manifest in save_path/manifests, keyed by the source files and recording their size
+    and mtime as well as the patch parameters, rows whose manifests match are skipped, so an interrupted run resumes
+    where it stopped and a rerun only extracts the tiles that have changed
     :param kwargs:
         file_list: list of lists of the files, can be generated by using collectionMaker.load_files()
         file_exts: extensions of the new files
+        force_run: if True, the manifests are ignored and every tile will be extracted
+        patch_filter: dictionary of the parameters of data_utils.filter_patches(), the first two files of each row are
+                      used as the rgb and the gt, the same patches are dropped from every file of the row, if None,
+                      every patch is kept
     :return:
     """
-    def extract_(file_list, file_exts, patch_size, pad, overlap, save_path):
-        assert len(file_exts) == len(file_list[0])
-        pbar = tqdm(file_list)
-        record_file = open(os.path.join(save_path, 'file_list.txt'), 'w')
-        for files in pbar:
-            pbar.set_description('Extracting {}'.format(os.path.basename(files[0])))
-            patch_list = []
-            for f, ext in zip(files, file_exts):
-                patch_list_ext = []
-                img = misc_utils.load_file(f)
-                grid_list = make_grid(np.array(img.shape[:2]) + 2 * pad, patch_size, overlap)
-                # extract images
-                for patch, y, x in patch_block(img, pad, grid_list, patch_size, return_coord=True):
-                    patch_name = '{}_y{}x{}.{}'.format(os.path.basename(f).split('.')[0], int(y), int(x), ext)
-                    patch_name = os.path.join(save_path, patch_name)
-                    misc_utils.save_file(patch_name, patch.astype(np.uint8))
-                    patch_list_ext.append(patch_name)
-                patch_list.append(patch_list_ext)
-            patch_list = misc_utils.rotate_list(patch_list)
-            for items in patch_list:
-                record_file.write('{}\n'.format(' '.join(items)))
-        record_file.close()
-
-    def check_finish(state_file):
-        """
-        check if state file exists
-        :return: True if it has finished
-        """
-        state_exist = os.path.exists(state_file)
-        if state_exist:
-            with open(state_file, 'r') as f:
-                a = f.readlines()
-                if a[0].strip() == 'Finished':
-                    return True
-        return False
-
-    # check if state file exists
+    def extract_(files, file_exts, patch_size, pad, overlap, save_path):
+        imgs = [misc_utils.load_file(f) for f in files]
+        grid_list = make_grid(np.array(imgs[0].shape[:2]) + 2 * pad, patch_size, overlap)
+        if patch_filter:
+            from data import data_utils
+            assert len(imgs) >= 2, 'patch_filter needs the rgb and the gt files'
+            keep = data_utils.filter_patches(pad_image(imgs[0], pad), pad_image(imgs[1], pad), grid_list, patch_size,
+                                             **patch_filter)[0]
+            grid_list = [a for a, k in zip(grid_list, keep) if k]
+        patch_list = []
+        for f, ext, img in zip(files, file_exts, imgs):
+            patch_list_ext = []
+            # extract images
+            for patch, y, x in patch_block(img, pad, grid_list, patch_size, return_coord=True):
+                patch_name = '{}_y{}x{}.{}'.format(os.path.basename(f).split('.')[0], int(y), int(x), ext)
+                patch_name = os.path.join(save_path, patch_name)
+                misc_utils.save_file(patch_name, patch.astype(np.uint8, copy=False))
+                patch_list_ext.append(patch_name)
+            patch_list.append(patch_list_ext)
+        return ['{}\n'.format(' '.join(items)) for items in misc_utils.rotate_list(patch_list)]
+
+    assert len(file_exts) == len(file_list[0])
+    # write state log as incomplete
     state_file = os.path.join(save_path, 'state.txt')
-    state_exist = os.path.exists(state_file)
-    # run the function if force run or haven't run before
-    if force_run or state_exist == 0:
-        print('Start running patch extractor')
-        # write state log as incomplete
-        with open(state_file, 'w') as f:
-            f.write('Incomplete\n')
-        extract_(file_list, file_exts, patch_size, pad, overlap, save_path)
-        # write state log as complete
-        with open(state_file, 'w') as f:
-            f.write('Finished\n')
-    else:
-        # if haven't run before, run the process
-        if not check_finish(state_file):
-            extract_(file_list, file_exts, patch_size, pad, overlap, save_path)
+    with open(state_file, 'w') as f:
+        f.write('Incomplete\n')
+
+    manifest_dir = os.path.join(save_path, 'manifests')
+    misc_utils.make_dir_if_not_exist(manifest_dir)
+    params = [list(file_exts), patch_size, pad, overlap, patch_filter]
+    records, skip_cnt = [], 0
+    pbar = tqdm(file_list)
+    for files in pbar:
+        signature = misc_utils.get_tile_signature(files, params)
+        manifest_file = misc_utils.get_manifest_file(manifest_dir, files)
+        tile_records = None
+        if not force_run:
+            tile_records = misc_utils.load_manifest(manifest_file, signature)
+        if tile_records is None:
+            pbar.set_description('Extracting {}'.format(os.path.basename(files[0])))
+            tile_records = extract_(files, file_exts, patch_size, pad, overlap, save_path)
+            misc_utils.save_manifest(manifest_file, signature, tile_records)
+        else:
+            skip_cnt += 1
+        records.extend(tile_records)
+    print('{} tiles are up to date, {} tiles extracted'.format(skip_cnt, len(file_list) - skip_cnt))
+    misc_utils.save_file(os.path.join(save_path, 'file_list.txt'), records)
 
-        # write state log as complete
-        with open(state_file, 'w') as f:
-            f.write('Finished\n')
+    # write state log as complete
+    with open(state_file, 'w') as f:
+        f.write('Finished\n')
 
 
 if __name__ == '__main__':
@@ -4,7 +4,6 @@ from glob import glob
 
 # Libs
 import numpy as np
-from tqdm import tqdm
 from natsort import natsorted
 
 # Own modules
@@ -13,6 +12,8 @@ from mrs_utils import misc_utils, process_block
 
 # Settings
 DS_NAME = 'spca'
+# patches that are mostly no-data (black) are dropped, set min_fg to also drop the patches without solar panels
+PATCH_FILTER = {'max_blank': 0.5, 'min_fg': None, 'nodata_val': 0}
 
 
 def get_images(data_dir, valid_percent=0.5, split=False):
@@ -39,39 +40,42 @@ def get_images(data_dir, valid_percent=0.5, split=False):
         return [a[0] for a in valid_files], [a[1] for a in valid_files]
 
 
-def create_dataset(data_dir, save_dir, patch_size, pad, overlap, valid_percent=0.1, visualize=False):
+def extract_tile(rgb_file, gt_file, patch_dir, prefix, patch_size, pad, overlap, save_patches=False,
+                 visualize=False, codec='jpg', quality=None, patch_filter=None):
+    """
+    Extract one spca tile into patches
+    :param save_patches: if False, only the records are made, the patches are assumed to be extracted already
+    :param visualize: if True, every patch will be displayed, this only works with a single process
+    :param codec: format of the image patches, npy, png, jpg or webp, see data_utils.get_patch_codec()
+    :param quality: quality of the lossy formats, if None, the PIL default will be used
+    :param patch_filter: thresholds to drop the blank and empty patches, see data_utils.filter_patches(), if None,
+                         every patch is kept
+    :return: records in the file list and #patches rejected by the patch filter
+    """
+    if visualize:
+        from mrs_utils import vis_utils
+        for rgb_patch, gt_patch, _, _ in data_utils.patch_tile(rgb_file, gt_file, patch_size, pad, overlap,
+                                                               patch_filter=patch_filter):
+            vis_utils.compare_figures([rgb_patch, gt_patch], (1, 2), fig_size=(12, 5))
+    return data_utils.extract_tile(rgb_file, gt_file, patch_dir, prefix, patch_size, pad, overlap,
+                                   codec=codec, quality=quality, save_patches=save_patches, patch_filter=patch_filter)
+
+
+def create_dataset(data_dir, save_dir, patch_size, pad, overlap, valid_percent=0.1, visualize=False,
+                   save_patches=False, n_workers=0, codec='jpg', quality=None, patch_filter=PATCH_FILTER):
     # create folders and files
     patch_dir = os.path.join(save_dir, 'patches')
     misc_utils.make_dir_if_not_exist(patch_dir)
-    record_file_train = open(os.path.join(save_dir, 'file_list_train_{}.txt').format(
-        misc_utils.float2str(valid_percent)), 'w+')
-    record_file_valid = open(os.path.join(save_dir, 'file_list_valid_{}.txt').format(
-        misc_utils.float2str(valid_percent)), 'w+')
     train_files, valid_files = get_images(data_dir, valid_percent, split=True)
 
-    for img_file, lbl_file in tqdm(train_files):
-        city_name = os.path.splitext(os.path.basename(img_file))[0].split('_')[0]
-        for rgb_patch, gt_patch, y, x in data_utils.patch_tile(img_file, lbl_file, patch_size, pad, overlap):
-            if visualize:
-                from mrs_utils import vis_utils
-                vis_utils.compare_figures([rgb_patch, gt_patch], (1, 2), fig_size=(12, 5))
-            img_patchname = '{}_y{}x{}.jpg'.format(city_name, int(y), int(x))
-            lbl_patchname = '{}_y{}x{}.png'.format(city_name, int(y), int(x))
-            # misc_utils.save_file(os.path.join(patch_dir, img_patchname), rgb_patch.astype(np.uint8))
-            # misc_utils.save_file(os.path.join(patch_dir, lbl_patchname), gt_patch.astype(np.uint8))
-            record_file_train.write('{} {}\n'.format(img_patchname, lbl_patchname))
-
-    for img_file, lbl_file in tqdm(valid_files):
-        city_name = os.path.splitext(os.path.basename(img_file))[0].split('_')[0]
-        for rgb_patch, gt_patch, y, x in data_utils.patch_tile(img_file, lbl_file, patch_size, pad, overlap):
-            if visualize:
-                from mrs_utils import vis_utils
-                vis_utils.compare_figures([rgb_patch, gt_patch], (1, 2), fig_size=(12, 5))
-            img_patchname = '{}_y{}x{}.jpg'.format(city_name, int(y), int(x))
-            lbl_patchname = '{}_y{}x{}.png'.format(city_name, int(y), int(x))
-            # misc_utils.save_file(os.path.join(patch_dir, img_patchname), rgb_patch.astype(np.uint8))
-            # misc_utils.save_file(os.path.join(patch_dir, lbl_patchname), gt_patch.astype(np.uint8))
-            record_file_valid.write('{} {}\n'.format(img_patchname, lbl_patchname))
+    tasks = []
+    for split, split_files in [('train', train_files), ('valid', valid_files)]:
+        for img_file, lbl_file in split_files:
+            city_name = os.path.splitext(os.path.basename(img_file))[0].split('_')[0]
+            tasks.append((split, (img_file, lbl_file, patch_dir, city_name, patch_size, pad, overlap, save_patches,
+                                  visualize, codec, quality, patch_filter)))
+    data_utils.parallel_extract(extract_tile, tasks, save_dir, n_workers,
+                                list_name='file_list_{}_' + '{}.txt'.format(misc_utils.float2str(valid_percent)))
 
 
 def get_stats(img_dir):
@@ -0,0 +1,206 @@
+"""
+This file defines readers that only read the requested windows of a tile from the disk or a memory map, so that huge
+rasters (e.g. county-scale mosaics) can be patched without decoding the whole tile into memory
+"""
+
+
+# Built-in
+import os
+
+# Libs
+import numpy as np
+
+# Own modules
+from mrs_utils import misc_utils
+
+
+def reflect_index(idx, length):
+    """
+    Map indices outside of [0, length) back into the tile the same way as np.pad(mode='reflect') does
+    :param idx: array of indices, could be negative or larger than length
+    :param length: length of the tile along this axis
+    :return: array of indices inside the tile
+    """
+    if length == 1:
+        return np.zeros_like(idx)
+    period = 2 * (length - 1)
+    idx = np.abs(idx) % period
+    return np.where(idx >= length, period - idx, idx)
+
+
+class WindowReader(object):
+    """
+    Basic window reader, child classes need to define shape and read_window()
+    """
+    shape = None
+
+    def read_window(self, y0, y1, x0, x1):
+        """
+        Read the window [y0:y1, x0:x1] of the tile, the window should be inside the tile
+        :param y0: top of the window
+        :param y1: bottom of the window
+        :param x0: left of the window
+        :param x1: right of the window
+        :return: h*w*c or h*w array
+        """
+        raise NotImplementedError()
+
+    def read_all(self):
+        """
+        Read the whole tile into memory
+        :return: the tile as a numpy array
+        """
+        return self.read_window(0, self.shape[0], 0, self.shape[1])
+
+    def close(self):
+        """
+        Release the file handles of the reader, nothing to do by default
+        :return:
+        """
+        pass
+
+    def read_patch(self, y, x, patch_size, pad=0, mode='reflect'):
+        """
+        Read a patch as if the tile has been padded by pad pixels around, pixels outside the tile are synthesized by
+        reflecting the pixels inside the tile, which is identical to pad_image() followed by crop_image()
+        :param y: top of the patch in the padded tile
+        :param x: left of the patch in the padded tile
+        :param patch_size: size of the patch
+        :param pad: #pixels padded around the tile
+        :param mode: padding mode, only reflect is supported
+        :return: the patch
+        """
+        assert mode == 'reflect'
+        h, w = self.shape[:2]
+        y0, x0 = y - pad, x - pad
+        y1, x1 = y0 + patch_size[0], x0 + patch_size[1]
+        if y0 >= 0 and x0 >= 0 and y1 <= h and x1 <= w:
+            return self.read_window(y0, y1, x0, x1)
+        rows = reflect_index(np.arange(y0, y1), h)
+        cols = reflect_index(np.arange(x0, x1), w)
+        r0, r1, c0, c1 = rows.min(), rows.max() + 1, cols.min(), cols.max() + 1
+        window = self.read_window(r0, r1, c0, c1)
+        return window[np.ix_(rows - r0, cols - c0)]
+
+
+class ArrayWindowReader(WindowReader):
+    def __init__(self, data, channels=None):
+        """
+        Read windows from an in memory or a memory mapped array
+        :param data: h*w*c or h*w array, could be a np.memmap
+        :param channels: #channels to keep, if None, all channels will be kept
+        """
+        self.data = data
+        self.channels = channels
+        if len(data.shape) == 3 and channels:
+            self.shape = (data.shape[0], data.shape[1], channels)
+        else:
+            self.shape = data.shape
+
+    def read_window(self, y0, y1, x0, x1):
+        if len(self.data.shape) == 3 and self.channels:
+            return np.asarray(self.data[y0:y1, x0:x1, :self.channels])
+        return np.asarray(self.data[y0:y1, x0:x1])
+
+
+class RasterWindowReader(WindowReader):
+    def __init__(self, file_name, channels=None):
+        """
+        Read windows from a raster file (e.g. GeoTIFF) with rasterio, only the blocks covering the window are decoded
+        :param file_name: path to the raster file
+        :param channels: #channels to keep, if None, all channels will be kept
+        """
+        import rasterio
+        from rasterio.windows import Window
+        self.window_func = Window
+        self.src = rasterio.open(file_name)
+        if channels:
+            self.band_ids = list(range(1, min(channels, self.src.count) + 1))
+        else:
+            self.band_ids = list(range(1, self.src.count + 1))
+        if len(self.band_ids) == 1:
+            self.shape = (self.src.height, self.src.width)
+        else:
+            self.shape = (self.src.height, self.src.width, len(self.band_ids))
+
+    def read_window(self, y0, y1, x0, x1):
+        data = self.src.read(self.band_ids, window=self.window_func(int(x0), int(y0), int(x1 - x0), int(y1 - y0)))
+        if len(self.band_ids) == 1:
+            return data[0, :, :]
+        return np.moveaxis(data, 0, -1)
+
+    def close(self):
+        self.src.close()
+
+
+def open_tile(file_name, channels=None):
+    """
+    Open a tile for windowed reading, .npy files are memory mapped, rasters are read with rasterio if it is installed,
+    uncompressed tiff files fall back to tifffile memory map, otherwise the whole file is loaded
+    :param file_name: path to the tile
+    :param channels: #channels to keep, if None, all channels will be kept
+    :return: a WindowReader instance
+    """
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext == '.npy':
+        return ArrayWindowReader(np.load(file_name, mmap_mode='r'), channels)
+    if ext in ['.tif', '.tiff']:
+        try:
+            return RasterWindowReader(file_name, channels)
+        except ImportError:
+            pass
+        try:
+            import tifffile
+            return ArrayWindowReader(tifffile.memmap(file_name, mode='r'), channels)
+        except (ImportError, ValueError):
+            pass
+    return ArrayWindowReader(misc_utils.load_file(file_name), channels)
+
+
+def get_tile_dim(file_name):
+    """
+    Get the height and width of a tile from its header, the pixels are not decoded unless the format is not supported
+    :param file_name: path to the tile
+    :return: tuple of the height and the width
+    """
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext == '.npy':
+        return tuple(np.load(file_name, mmap_mode='r').shape[:2])
+    if ext in ['.tif', '.tiff']:
+        try:
+            import rasterio
+            with rasterio.open(file_name) as src:
+                return src.height, src.width
+        except ImportError:
+            pass
+    try:
+        from PIL import Image
+        Image.MAX_IMAGE_PIXELS = None
+        with Image.open(file_name) as img:
+            return img.size[1], img.size[0]
+    except (ImportError, OSError):
+        pass
+    return tuple(misc_utils.load_file(file_name).shape[:2])
+
+
+def patch_block_windowed(reader, pad, grid_list, patch_size, return_coord=False):
+    """
+    Same as patch_extractor.patch_block() but the patches are read from a WindowReader one at a time, the padding is
+    synthesized at the borders so the padded tile is never made
+    :param reader: a WindowReader instance
+    :param pad: #pixels to pad around
+    :param grid_list: list of grids
+    :param patch_size: size of the patch
+    :param return_coord: if True, coordinates of x and y will be returned
+    :return: yields patches or as well as x and y coordinates
+    """
+    for y, x in grid_list:
+        patch = reader.read_patch(y, x, patch_size, pad)
+        if return_coord:
+            yield patch, y, x
+        else:
+            yield patch
+
+
+if __name__ == '__main__':
+    pass
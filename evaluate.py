@@ -22,6 +22,9 @@ LOAD_EPOCH = 80
 DATA_DIR = r'/home/wh145/mnih'
 DS_NAME = 'mnih'
 PATCHS_SIZE = (512, 512)
+BATCH_SIZE = 8
+PRECISION = 'fp32'     # fp32, fp16 or amp
+CHANNELS_LAST = False
 
 
 def main():
@@ -46,7 +49,8 @@ def main():
         ToTensorV2(),
     ])
     save_dir = os.path.join(r'/home/wh145/results/mrs/mass_roads', os.path.basename(network_utils.unique_model_name(args)))
-    evaluator = eval_utils.Evaluator(DS_NAME, DATA_DIR, tsfm_valid, device)
+    evaluator = eval_utils.Evaluator(DS_NAME, DATA_DIR, tsfm_valid, device, batch_size=BATCH_SIZE,
+                                     precision=PRECISION, channels_last=CHANNELS_LAST)
     evaluator.evaluate(model, PATCHS_SIZE, 2*model.lbl_margin,
                        pred_dir=save_dir, report_dir=save_dir)
 
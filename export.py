@@ -0,0 +1,28 @@
+"""
+Export a model trained by train.py into inference only TorchScript and ONNX artifacts, the exported model.pt or
+model.onnx can be passed to Evaluator.evaluate() or Evaluator.infer() directly
+"""
+
+
+# Built-in
+
+# Libs
+
+# Own modules
+from network import network_io
+
+
+# Settings
+MODEL_DIR = r'/home/wh145/models/ecvgg16_dcunet_dsmnih_lre1e-03_lrd1e-02_ep80_bs5_ds50_dr0p1'
+SAVE_DIR = None
+LOAD_EPOCH = 80
+INPUT_SIZE = (512, 512)
+EXPORT_ONNX = True
+
+
+def main():
+    network_io.export_model(MODEL_DIR, SAVE_DIR, LOAD_EPOCH, INPUT_SIZE, EXPORT_ONNX)
+
+
+if __name__ == '__main__':
+    main()
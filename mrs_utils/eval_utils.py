@@ -6,6 +6,12 @@
 # Built-in
 import os
 import re
+import time
+import queue
+import copy
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 
 # Libs
 import scipy.special
@@ -25,7 +31,7 @@ import torch
 import torch.nn.functional as F
 
 # Own modules
-from data import patch_extractor, data_utils
+from data import patch_extractor, data_utils, tile_reader
 from mrs_utils import vis_utils, metric_utils, misc_utils
 
 
@@ -355,11 +361,88 @@ def get_fps(conf, true):
     return fps[sl]
 
 
+def dense_crf(conf, rgb, crf_params, n_iter=5):
+    """
+    Refine the confidence map with DenseCRF
+    :param conf: h*w*c confidence map
+    :param rgb: h*w*3 rgb image
+    :param crf_params: parameters of the pairwise bilateral term
+    :param n_iter: #iterations of the mean field inference
+    :return: h*w*c refined probabilities
+    """
+    h, w, c = conf.shape
+    d = dcrf.DenseCRF2D(w, h, c)
+    U = unary_from_softmax(np.ascontiguousarray(data_utils.change_channel_order(conf, False)))
+    d.setUnaryEnergy(U)
+    d.addPairwiseBilateral(rgbim=np.ascontiguousarray(rgb), **crf_params)
+    Q = np.array(d.inference(n_iter), dtype=np.float32).reshape((c, h, w))
+    return data_utils.change_channel_order(Q, True)
+
+
+def get_window_starts(length, window, overlap):
+    """
+    Get the start of each window along one axis, this follows the same rule as patch_extractor.make_grid()
+    :param length: length of the tile along this axis
+    :param window: length of the window
+    :param overlap: #overlapping pixels between adjacent windows
+    :return: list of window starts
+    """
+    if length <= window:
+        return [0]
+    assert window > overlap, 'window ({}) should be larger than the overlap ({})'.format(window, overlap)
+    n_step = int(np.ceil(length / (window - overlap)))
+    return [int(a) for a in np.floor(np.linspace(0, length - window, n_step))]
+
+
+def crf_refine(conf, rgb, crf_params, window_size=None, window_overlap=64, n_iter=5):
+    """
+    Refine the confidence map with DenseCRF and make the prediction mask, this is a module level function so that it
+    can be submitted to a process pool
+    If window_size is given, the CRF runs on overlapping windows of the tile and the refined probabilities are blended
+    back together, which bounds the memory of each CRF call
+    :param conf: h*w*c confidence map
+    :param rgb: h*w*3 rgb image
+    :param crf_params: parameters of the pairwise bilateral term
+    :param window_size: size of the CRF windows, if None, the CRF runs on the whole tile
+    :param window_overlap: #overlapping pixels between adjacent windows
+    :param n_iter: #iterations of the mean field inference
+    :return: h*w prediction mask and #seconds spent
+    """
+    start_time = time.time()
+    if window_size is None:
+        Q = dense_crf(conf, rgb, crf_params, n_iter)
+    else:
+        tile_dim = conf.shape[:2]
+        window = (min(window_size, tile_dim[0]), min(window_size, tile_dim[1]))
+        grid_list = [(y, x) for y in get_window_starts(tile_dim[0], window[0], window_overlap)
+                     for x in get_window_starts(tile_dim[1], window[1], window_overlap)]
+        stitcher = patch_extractor.PatchStitcher(tile_dim, window, grid_list=grid_list)
+        for y, x in grid_list:
+            stitcher.add(dense_crf(conf[y:y + window[0], x:x + window[1], :], rgb[y:y + window[0], x:x + window[1], :],
+                                   crf_params, n_iter))
+        Q = stitcher.get_tile()
+    return np.argmax(Q, axis=-1), time.time() - start_time
+
+
 class Evaluator:
-    def __init__(self, ds_name, data_dir, tsfm, device, load_func=None, infer=False, ensembler=None, **kwargs):
+    def __init__(self, ds_name, data_dir, tsfm, device, load_func=None, infer=False, ensembler=None, batch_size=1,
+                 stitch_dtype=np.float32, stitch_on_device=False, windowed_read=False, model_devices=None,
+                 precision='fp32', channels_last=False, **kwargs):
         ds_name = misc_utils.stem_string(ds_name)
         self.tsfm = tsfm
         self.device = device
+        self.batch_size = batch_size
+        self.stitch_dtype = stitch_dtype
+        self.stitch_on_device = stitch_on_device
+        self.windowed_read = windowed_read
+        # fp32, fp16 (half precision weights) or amp (autocast)
+        self.precision = misc_utils.stem_string(precision)
+        assert self.precision in ['fp32', 'fp16', 'amp']
+        self.channels_last = channels_last
+        # with one device per model, models of an ensemble run concurrently, the thread pool only lives during
+        # evaluate() and infer()
+        self.model_devices = model_devices
+        self.model_pool = None
         if ensembler is None:
             self.ensembler = BaseEnsemble()
         else:
@@ -437,154 +520,597 @@ class Evaluator:
         return print_string, report_string
 
     def evaluate(self, model, patch_size, overlap, pred_dir=None, report_dir=None, save_conf=False, delta=1e-6,
-                 eval_class=(1, ), visualize=False, densecrf=False, crf_params=None, verbose=True):
-        if isinstance(model, list) or isinstance(model, tuple):
-            lbl_margin = model[0].lbl_margin
-        else:
-            lbl_margin = model.lbl_margin
+                 eval_class=(1, ), visualize=False, densecrf=False, crf_params=None, verbose=True, crf_workers=0,
+                 crf_window=None, crf_window_overlap=64):
         if crf_params is None and densecrf:
             crf_params = {'sxy': 3, 'srgb': 3, 'compat': 5}
+        model = self.prepare_model(model)
+        # with a CRF pool, the loop moves on to the next tile while the CRF of previous tiles finishes
+        crf_pool = None
+        if densecrf and crf_workers > 0:
+            crf_pool = ProcessPoolExecutor(crf_workers)
+        timer = misc_utils.StageTimer()
 
-        iou_a, iou_b = np.zeros(len(eval_class)), np.zeros(len(eval_class))
         report = []
+        iou_scores = []
         if pred_dir:
             misc_utils.make_dir_if_not_exist(pred_dir)
-        for rgb_file, lbl_file in zip(self.rgb_files, self.lbl_files):
-            file_name = os.path.splitext(os.path.basename(lbl_file))[0]
-
-            # read data
-            rgb = misc_utils.load_file(rgb_file)[:, :, :3]
-            lbl = misc_utils.load_file(lbl_file)
-            if self.decode_func:
-                lbl = self.decode_func(lbl)
-
-            # evaluate on tiles
-            tile_dim = rgb.shape[:2]
-            tile_dim_pad = [tile_dim[0]+2*lbl_margin, tile_dim[1]+2*lbl_margin]
-            grid_list = patch_extractor.make_grid(tile_dim_pad, patch_size, overlap)
-
-            if isinstance(model, list) or isinstance(model, tuple):
-                tile_preds = 0
-                for m in model:
-                    tile_preds = tile_preds + self.infer_tile(m, rgb, grid_list, patch_size, tile_dim, tile_dim_pad, lbl_margin)
-            else:
-                tile_preds = self.infer_tile(model, rgb, grid_list, patch_size, tile_dim, tile_dim_pad, lbl_margin)
-
-            if save_conf:
-                misc_utils.save_file(os.path.join(pred_dir, '{}.npy'.format(file_name)), tile_preds[:, :, 1])
-
-            if densecrf:
-                d = dcrf.DenseCRF2D(*tile_preds.shape)
-                U = unary_from_softmax(np.ascontiguousarray(
-                    data_utils.change_channel_order(tile_preds, False)))
-                d.setUnaryEnergy(U)
-                d.addPairwiseBilateral(rgbim=rgb, **crf_params)
-                Q = d.inference(5)
-                tile_preds = np.argmax(Q, axis=0).reshape(*tile_preds.shape[:2])
-            else:
-                tile_preds = np.argmax(tile_preds, -1)
+
+        def finish(file_name, rgb, lbl, tile_preds):
+            if isinstance(tile_preds, Future):
+                with timer.time('crf_wait'):
+                    tile_preds, crf_time = tile_preds.result()
+                timer.add('crf', crf_time)
             iou_score = metric_utils.iou_metric(lbl/self.truth_val, tile_preds, eval_class=eval_class)
             pstr, rstr = self.get_result_strings(file_name, iou_score, delta)
             tm.misc_utils.verb_print(pstr, verbose)
             report.append(rstr)
-            iou_a += iou_score[0, :]
-            iou_b += iou_score[1, :]
+            iou_scores.append(iou_score)
             if visualize:
+                rgb_img = self.read_tile(rgb)
                 if self.encode_func:
-                    vis_utils.compare_figures([rgb, self.encode_func(lbl), self.encode_func(tile_preds)], (1, 3),
+                    vis_utils.compare_figures([rgb_img, self.encode_func(lbl), self.encode_func(tile_preds)], (1, 3),
                                               fig_size=(15, 5))
                 else:
-                    vis_utils.compare_figures([rgb, lbl, tile_preds], (1, 3), fig_size=(15, 5))
+                    vis_utils.compare_figures([rgb_img, lbl, tile_preds], (1, 3), fig_size=(15, 5))
             if pred_dir:
                 if self.encode_func:
                     misc_utils.save_file(os.path.join(pred_dir, '{}.png'.format(file_name)), self.encode_func(tile_preds))
                 else:
                     misc_utils.save_file(os.path.join(pred_dir, '{}.png'.format(file_name)), tile_preds)
+            self.close_tile(rgb)
+
+        pending = deque()
+        self.start_model_pool()
+        try:
+            for rgb_file, lbl_file in zip(self.rgb_files, self.lbl_files):
+                file_name = os.path.splitext(os.path.basename(lbl_file))[0]
+
+                # read data
+                with timer.time('read'):
+                    rgb = self.load_tile(rgb_file)
+                    lbl = misc_utils.load_file(lbl_file)
+                    if self.decode_func:
+                        lbl = self.decode_func(lbl)
+
+                # evaluate on tiles
+                with timer.time('model'):
+                    tile_preds = self.predict_tile(model, rgb, patch_size, overlap)
+
+                if save_conf:
+                    misc_utils.save_file(os.path.join(pred_dir, '{}.npy'.format(file_name)),
+                                         self.get_tile_conf(tile_preds)[:, :, 1])
+
+                if crf_pool is not None:
+                    tile_preds = crf_pool.submit(crf_refine, self.get_tile_conf(tile_preds), self.read_tile(rgb),
+                                                 crf_params, crf_window, crf_window_overlap)
+                else:
+                    with timer.time('post'):
+                        tile_preds = self.post_process(tile_preds, rgb, densecrf, crf_params, crf_window,
+                                                       crf_window_overlap)
+                pending.append((file_name, rgb, lbl, tile_preds))
+                while len(pending) > crf_workers:
+                    finish(*pending.popleft())
+            while len(pending) > 0:
+                finish(*pending.popleft())
+        finally:
+            self.stop_model_pool()
+            if crf_pool is not None:
+                crf_pool.shutdown(wait=True)
+
+        iou_a, iou_b = np.zeros(len(eval_class)), np.zeros(len(eval_class))
+        for iou_score in iou_scores:
+            iou_a += iou_score[0, :]
+            iou_b += iou_score[1, :]
         pstr, rstr = self.get_result_strings('Overall', np.stack([iou_a, iou_b], axis=0), delta)
         tm.misc_utils.verb_print(pstr, verbose)
+        tm.misc_utils.verb_print(timer.report(), verbose)
         report.append(rstr)
         if report_dir:
             misc_utils.make_dir_if_not_exist(report_dir)
             misc_utils.save_file(os.path.join(report_dir, 'result.txt'), report)
         return np.mean(iou_a / (iou_b + delta))*100
 
-    def infer_tile(self, model, rgb, grid_list, patch_size, tile_dim, tile_dim_pad, lbl_margin):
-        tile_preds = []
-        for patch in patch_extractor.patch_block(rgb, model.lbl_margin, grid_list, patch_size, False):
-            patch_preds = []
-            for aug_patch in self.ensembler.augment_data(patch):
+    def compare_precision(self, model, patch_size, overlap, precision='fp16', channels_last=True, verbose=True,
+                          **kwargs):
+        """
+        Evaluate the model in float32 and in the given reduced precision on the evaluation set and report the IoU
+        delta, this helps to decide whether reduced precision can be turned on for the model
+        The model is copied before the conversion so the given model is not changed
+        :param model: the model or a list of models to do the inference
+        :param patch_size: size of the patches
+        :param overlap: #overlapping pixels between patches
+        :param precision: the reduced precision to compare with, fp16 or amp
+        :param channels_last: if True, the reduced precision run will use the channels last memory format
+        :param verbose: if True, print the results
+        :param kwargs: other parameters passed to evaluate()
+        :return: IoU in float32, IoU in reduced precision and the delta between them
+        """
+        settings = (self.precision, self.channels_last)
+        try:
+            self.precision, self.channels_last = 'fp32', False
+            start_time = time.time()
+            iou_fp32 = self.evaluate(model, patch_size, overlap, verbose=False, **kwargs)
+            time_fp32 = time.time() - start_time
+            self.precision, self.channels_last = misc_utils.stem_string(precision), channels_last
+            start_time = time.time()
+            iou_reduced = self.evaluate(model, patch_size, overlap, verbose=False, **kwargs)
+            time_reduced = time.time() - start_time
+        finally:
+            self.precision, self.channels_last = settings
+        tm.misc_utils.verb_print('fp32: IoU={:05.2f} ({:.1f}s), {}{}: IoU={:05.2f} ({:.1f}s), delta={:+.3f}'.format(
+            iou_fp32, time_fp32, precision, ' channels last' if channels_last else '', iou_reduced, time_reduced,
+            iou_reduced - iou_fp32), verbose)
+        return iou_fp32, iou_reduced, iou_reduced - iou_fp32
+
+    def start_model_pool(self):
+        """
+        Start the thread pool that runs the models of an ensemble concurrently, one thread for each model device
+        :return:
+        """
+        if self.model_devices is not None and len(self.model_devices) > 1:
+            self.model_pool = ThreadPoolExecutor(len(self.model_devices))
+
+    def stop_model_pool(self):
+        """
+        Shut down the thread pool started by start_model_pool()
+        :return:
+        """
+        if self.model_pool is not None:
+            self.model_pool.shutdown(wait=True)
+            self.model_pool = None
+
+    def load_tile(self, rgb_file):
+        """
+        Load the rgb tile, if windowed reading is enabled, only a window reader is opened and the patches will be read
+        from the disk or memory map on demand
+        :param rgb_file: path to the rgb tile
+        :return: h*w*3 array or a tile_reader.WindowReader
+        """
+        if self.windowed_read:
+            return tile_reader.open_tile(rgb_file, channels=3)
+        return misc_utils.load_file(rgb_file)[:, :, :3]
+
+    @staticmethod
+    def read_tile(rgb):
+        """
+        Make sure the whole rgb tile is in memory, this is only needed by the DenseCRF and the visualization
+        :param rgb: h*w*3 array or a tile_reader.WindowReader
+        :return: h*w*3 array
+        """
+        if isinstance(rgb, tile_reader.WindowReader):
+            return rgb.read_all()
+        return rgb
+
+    @staticmethod
+    def close_tile(rgb):
+        """
+        Close the window reader of a tile once the tile is done, arrays are left as they are
+        :param rgb: h*w*3 array or a tile_reader.WindowReader
+        :return:
+        """
+        if isinstance(rgb, tile_reader.WindowReader):
+            rgb.close()
+
+    @staticmethod
+    def get_tile_conf(tile_preds):
+        """
+        Get the stitched confidence map as a h*w*c numpy array
+        :param tile_preds: stitched predictions, either a h*w*c array or a c*h*w tensor on the inference device
+        :return: h*w*c numpy array
+        """
+        if isinstance(tile_preds, torch.Tensor):
+            return data_utils.change_channel_order(tile_preds.float().cpu().numpy(), True)
+        return tile_preds
+
+    def post_process(self, tile_preds, rgb, densecrf=False, crf_params=None, crf_window=None, crf_window_overlap=64):
+        """
+        Turn the stitched confidence map into the prediction mask, either by argmax or by DenseCRF
+        If the tile is stitched on the device and no CRF is needed, argmax is also done there and only the uint8 mask
+        is copied back
+        :param tile_preds: stitched predictions, either a h*w*c array or a c*h*w tensor on the inference device
+        :param rgb: the rgb tile, this is used by the DenseCRF
+        :param densecrf: if True, DenseCRF will be applied
+        :param crf_params: parameters of the DenseCRF
+        :param crf_window: size of the CRF windows, if None, the CRF runs on the whole tile
+        :param crf_window_overlap: #overlapping pixels between adjacent CRF windows
+        :return: h*w prediction mask
+        """
+        if densecrf:
+            return crf_refine(self.get_tile_conf(tile_preds), self.read_tile(rgb), crf_params, crf_window,
+                              crf_window_overlap)[0]
+        elif isinstance(tile_preds, torch.Tensor):
+            return torch.argmax(tile_preds, 0).to(torch.uint8).cpu().numpy()
+        else:
+            return np.argmax(tile_preds, -1)
+
+    def prepare_model(self, model):
+        """
+        Convert the model(s) to the precision and memory format of this evaluator, paths to the artifacts made by
+        network_io.export_model() are loaded directly without rebuilding the model
+        The conversion is done on a copy, the given model is not changed
+        :param model: the model or a list of models to do the inference, or paths to the exported models
+        :return: the converted model(s)
+        """
+        from network import network_io
+        if isinstance(model, list) or isinstance(model, tuple):
+            return [self.prepare_model(m) for m in model]
+        if isinstance(model, str):
+            model = network_io.ExportedModel(model, self.device)
+            model.eval()
+        elif self.precision == 'fp16' or self.channels_last:
+            model = copy.deepcopy(model)
+        return network_io.set_inference_precision(model, self.precision == 'fp16', self.channels_last)
+
+    def model_forward(self, model, data):
+        """
+        Run the model on a batch of data on the device, the softmax is always computed in float32 so that the
+        accumulated predictions keep the full precision
+        :param model: the model to do the inference
+        :param data: n*c*h*w tensor on the device
+        :return: n*c*h*w softmax tensor on the device
+        """
+        with torch.no_grad():
+            if self.channels_last:
+                data = data.contiguous(memory_format=torch.channels_last)
+            if self.precision == 'fp16':
+                output = model.inference(data.half())
+            elif self.precision == 'amp':
+                with torch.autocast(device_type=data.device.type, dtype=torch.float16):
+                    output = model.inference(data)
+            else:
+                output = model.inference(data)
+            return F.softmax(output.float(), 1)
+
+    def transform_batch(self, patch_batch):
+        """
+        Apply the transforms to every augmented copy of the patches, this is done once no matter how many models are
+        there in the ensemble
+        :param patch_batch: list of augmented patches, each element is the output of ensembler.augment_data()
+        :return: list of n*c*h*w tensors, one for each augmented copy
+        """
+        aug_batches = []
+        for aug_cnt in range(len(patch_batch[0])):
+            aug_batch = []
+            for aug_patches in patch_batch:
+                aug_patch = aug_patches[aug_cnt]
                 for tsfm in self.tsfm:
                     tsfm_image = tsfm(image=aug_patch)
                     aug_patch = tsfm_image['image']
-                aug_patch = torch.unsqueeze(aug_patch, 0).to(self.device)
-                pred = F.softmax(model.inference(aug_patch), 1).detach().cpu().numpy()
-                patch_preds.append(pred)
-            tile_preds.append(data_utils.change_channel_order(self.ensembler.fuse_data(patch_preds), True)[0, :, :, :])
-        # stitch back to tiles
-        tile_preds = patch_extractor.unpatch_block(
-            np.array(tile_preds),
-            tile_dim_pad,
-            patch_size,
-            tile_dim,
-            [patch_size[0] - 2 * lbl_margin, patch_size[1] - 2 * lbl_margin],
-            overlap=2 * lbl_margin
-        )
-        return tile_preds
+                aug_batch.append(aug_patch)
+            aug_batches.append(torch.stack(aug_batch, 0))
+        return aug_batches
 
-    def infer(self, model, pred_dir, patch_size, overlap, ext='_mask', file_ext='png', visualize=False,
-              densecrf=False, crf_params=None, save_conf=False):
+    def forward_batch(self, model, aug_batches, device):
+        """
+        Run one model on the transformed copies of a batch and fuse the copies
+        If the ensembler works on tensors, the augmented copies are made from the stacked batch on the device instead
+        :param model: the model to do the inference
+        :param aug_batches: output of transform_batch()
+        :param device: the device where the model lives
+        :return: n*c*h*w fused predictions, on the device if the ensembler fuses tensors
+        """
+        aug_preds = []
+        for aug_batch in aug_batches:
+            aug_batch = aug_batch.to(device)
+            if self.ensembler.on_tensor:
+                aug_preds.append(self.ensembler.predict(lambda x: self.model_forward(model, x), aug_batch))
+            else:
+                aug_preds.append(self.model_forward(model, aug_batch))
+        if self.ensembler.on_tensor:
+            return aug_preds[0]
+        if not self.ensembler.tensor_fuse:
+            aug_preds = [a.cpu().numpy() for a in aug_preds]
+        n_patch = aug_batches[0].shape[0]
+        fuse_preds = [self.ensembler.fuse_data([a[cnt:cnt+1] for a in aug_preds]) for cnt in range(n_patch)]
+        if self.ensembler.tensor_fuse:
+            return torch.cat(fuse_preds, 0)
+        return torch.from_numpy(np.concatenate(fuse_preds, 0))
+
+    def infer_batch(self, model, patch_batch):
+        """
+        Run a batch of patches through the model, the same augmented copy of every patch in the batch is stacked
+        together so that each copy costs one forward pass for the whole batch
+        If model is a list, the patches are transformed once and fanned out to all the models, predictions of the
+        models are summed up
+        :param model: the model or a list of models to do the inference
+        :param patch_batch: list of augmented patches, each element is the output of ensembler.augment_data()
+        :return: fused predictions of the batch, a n*h*w*c array, or a n*c*h*w tensor on the device if the tile is
+                 stitched on the device
+        """
+        if isinstance(model, list) or isinstance(model, tuple):
+            models = model
+        else:
+            models = [model]
+        if self.model_devices is not None:
+            assert len(self.model_devices) == len(models)
+            devices = self.model_devices
+        else:
+            devices = [self.device for _ in models]
+        aug_batches = self.transform_batch(patch_batch)
+        if self.model_pool is not None:
+            preds = list(self.model_pool.map(lambda args: self.forward_batch(args[0], aug_batches, args[1]),
+                                             zip(models, devices)))
+        else:
+            preds = [self.forward_batch(m, aug_batches, d) for m, d in zip(models, devices)]
+
+        if self.stitch_on_device:
+            return sum([p.to(self.device) for p in preds])
+        # one device to host copy for the whole batch
+        fuse_preds = sum([p.cpu() for p in preds])
+        return data_utils.change_channel_order(fuse_preds.numpy(), True)
+
+    def make_stitcher(self, grid_list, patch_size, tile_dim, tile_dim_pad, lbl_margin):
+        """
+        Make the stitcher that accumulates the patch predictions of one tile
+        :param grid_list: list of grids in the padded tile
+        :param patch_size: size of the patches
+        :param tile_dim: dimension of the tile
+        :param tile_dim_pad: dimension of the padded tile
+        :param lbl_margin: #pixels the model shrinks at each side of the patch
+        :return: a PatchStitcher, or a TorchPatchStitcher if the tile is stitched on the device
+        """
+        patch_size_output = [patch_size[0] - 2 * lbl_margin, patch_size[1] - 2 * lbl_margin]
+        if self.stitch_on_device:
+            dtype = torch.float16 if self.stitch_dtype == np.float16 else torch.float32
+            return patch_extractor.TorchPatchStitcher(tile_dim_pad, patch_size, tile_dim, patch_size_output,
+                                                      grid_list=grid_list, dtype=dtype, device=self.device)
+        else:
+            return patch_extractor.PatchStitcher(tile_dim_pad, patch_size, tile_dim, patch_size_output,
+                                                 grid_list=grid_list, dtype=self.stitch_dtype)
+
+    def infer_tile(self, model, rgb, grid_list, patch_size, tile_dim, tile_dim_pad, lbl_margin):
+        # predictions are stitched back to the tile as soon as each batch is done
+        stitcher = self.make_stitcher(grid_list, patch_size, tile_dim, tile_dim_pad, lbl_margin)
+        patch_batch = []
+        if isinstance(rgb, tile_reader.WindowReader):
+            patches = tile_reader.patch_block_windowed(rgb, lbl_margin, grid_list, patch_size, False)
+        else:
+            patches = patch_extractor.patch_block(rgb, lbl_margin, grid_list, patch_size, False)
+        for patch in patches:
+            patch_batch.append(self.ensembler.augment_data(patch))
+            if len(patch_batch) == self.batch_size:
+                stitcher.add_batch(self.infer_batch(model, patch_batch))
+                patch_batch = []
+        if len(patch_batch) > 0:
+            stitcher.add_batch(self.infer_batch(model, patch_batch))
+        return stitcher.get_tile()
+
+    def predict_tile(self, model, rgb, patch_size, overlap):
+        """
+        Predict the stitched confidence map of one tile
+        If model is a list, the tile is read, patched and transformed only once, every model runs on the same patches
+        and the predictions are summed up into one canvas
+        :param model: the model or a list of models to do the inference
+        :param rgb: h*w*3 array or a tile_reader.WindowReader
+        :param patch_size: size of the patches
+        :param overlap: #overlapping pixels between patches
+        :return: stitched predictions, either a h*w*c array or a c*h*w tensor on the inference device
+        """
         if isinstance(model, list) or isinstance(model, tuple):
             lbl_margin = model[0].lbl_margin
+            assert all([m.lbl_margin == lbl_margin for m in model])
         else:
             lbl_margin = model.lbl_margin
-        if crf_params is None and densecrf:
-            crf_params = {'sxy': 3, 'srgb': 3, 'compat': 5}
+        tile_dim = rgb.shape[:2]
+        tile_dim_pad = [tile_dim[0] + 2 * lbl_margin, tile_dim[1] + 2 * lbl_margin]
+        grid_list = patch_extractor.make_grid(tile_dim_pad, patch_size, overlap)
+        return self.infer_tile(model, rgb, grid_list, patch_size, tile_dim, tile_dim_pad, lbl_margin)
 
-        misc_utils.make_dir_if_not_exist(pred_dir)
-        pbar = tqdm(self.rgb_files)
-        for rgb_file in pbar:
-            file_name = os.path.splitext(os.path.basename(rgb_file))[0].split('.')[0]
-            pbar.set_description('Inferring {}'.format(file_name))
-            # read data
-            rgb = misc_utils.load_file(rgb_file)[:, :, :3]
-
-            # evaluate on tiles
-            tile_dim = rgb.shape[:2]
-            tile_dim_pad = [tile_dim[0] + 2 * lbl_margin, tile_dim[1] + 2 * lbl_margin]
-            grid_list = patch_extractor.make_grid(tile_dim_pad, patch_size, overlap)
-
-            if isinstance(model, list) or isinstance(model, tuple):
-                tile_preds = 0
-                for m in model:
-                    tile_preds = tile_preds + self.infer_tile(m, rgb, grid_list, patch_size, tile_dim, tile_dim_pad,
-                                                              lbl_margin)
-            else:
-                tile_preds = self.infer_tile(model, rgb, grid_list, patch_size, tile_dim, tile_dim_pad, lbl_margin)
-
-            if save_conf:
-                misc_utils.save_file(os.path.join(pred_dir, '{}_conf.png'.format(file_name)), (tile_preds[:, :, 1] * 255).astype(np.uint8))
-
-            if densecrf:
-                d = dcrf.DenseCRF2D(*tile_preds.shape)
-                U = unary_from_softmax(np.ascontiguousarray(
-                    data_utils.change_channel_order(tile_preds, False)))
-                d.setUnaryEnergy(U)
-                d.addPairwiseBilateral(rgbim=rgb, **crf_params)
-                Q = d.inference(5)
-                tile_preds = np.argmax(Q, axis=0).reshape(*tile_preds.shape[:2])
-            else:
-                tile_preds = np.argmax(tile_preds, -1)
+    def read_stage(self, rgb_file):
+        """
+        First stage of inference: decode the tile
+        :param rgb_file: path to the rgb tile
+        :return: name of the tile and the decoded tile
+        """
+        file_name = os.path.splitext(os.path.basename(rgb_file))[0].split('.')[0]
+        return file_name, self.load_tile(rgb_file)
+
+    def post_stage(self, tile_preds, rgb, file_name, pred_dir, ext, file_ext, densecrf, crf_params, save_conf,
+                   crf_window=None, crf_window_overlap=64, crf_pool=None, timer=None):
+        """
+        Last stage of inference: post process the stitched confidence map, encode and write the prediction
+        :param tile_preds: stitched predictions, either a h*w*c array or a c*h*w tensor on the inference device
+        :param rgb: h*w*3 array or a tile_reader.WindowReader
+        :param file_name: name of the tile
+        :param pred_dir: directory to save the predictions
+        :param ext: suffix of the prediction file name
+        :param file_ext: file extension of the prediction
+        :param densecrf: if True, DenseCRF will be applied
+        :param crf_params: parameters of the DenseCRF
+        :param save_conf: if True, the confidence map will be saved as well
+        :param crf_window: size of the CRF windows, if None, the CRF runs on the whole tile
+        :param crf_window_overlap: #overlapping pixels between adjacent CRF windows
+        :param crf_pool: if given, the CRF will run in this process pool
+        :param timer: misc_utils.StageTimer to record the time spent
+        :return: the encoded prediction
+        """
+        if timer is None:
+            timer = misc_utils.StageTimer()
+        if save_conf:
+            misc_utils.save_file(os.path.join(pred_dir, '{}_conf.png'.format(file_name)),
+                                 (self.get_tile_conf(tile_preds)[:, :, 1] * 255).astype(np.uint8))
+
+        if densecrf and crf_pool is not None:
+            crf_future = crf_pool.submit(crf_refine, self.get_tile_conf(tile_preds), self.read_tile(rgb), crf_params,
+                                         crf_window, crf_window_overlap)
+            with timer.time('crf_wait'):
+                tile_preds, crf_time = crf_future.result()
+            timer.add('crf', crf_time)
+        else:
+            with timer.time('post'):
+                tile_preds = self.post_process(tile_preds, rgb, densecrf, crf_params, crf_window, crf_window_overlap)
 
+        with timer.time('write'):
             if self.encode_func:
                 pred_img = self.encode_func(tile_preds)
             else:
                 pred_img = tile_preds
+            misc_utils.save_file(os.path.join(pred_dir, '{}{}.{}'.format(file_name, ext, file_ext)), pred_img)
+        return pred_img
+
+    def infer(self, model, pred_dir, patch_size, overlap, ext='_mask', file_ext='png', visualize=False,
+              densecrf=False, crf_params=None, save_conf=False, read_workers=0, post_workers=0, queue_size=2,
+              crf_workers=0, crf_window=None, crf_window_overlap=64, verbose=True):
+        """
+        Run inference on all the tiles and write the predictions to pred_dir
+        If read_workers, post_workers or crf_workers is greater than 0, the tiles go through a three stage pipeline: a
+        thread pool decodes the tiles, the model runs on the calling thread, another thread pool does the post
+        processing and the encoding, the stages are connected by bounded queues so that the model never waits for
+        decoding or DenseCRF
+        :param model: the model or a list of models to do the inference
+        :param pred_dir: directory to save the predictions
+        :param patch_size: size of the patches
+        :param overlap: #overlapping pixels between patches
+        :param ext: suffix of the prediction file name
+        :param file_ext: file extension of the prediction
+        :param visualize: if True, the predictions will be displayed
+        :param densecrf: if True, DenseCRF will be applied
+        :param crf_params: parameters of the DenseCRF
+        :param save_conf: if True, the confidence map will be saved as well
+        :param read_workers: #threads to decode the tiles
+        :param post_workers: #threads to post process and write the predictions
+        :param queue_size: max #tiles waiting between two stages
+        :param crf_workers: if greater than 0, the DenseCRF runs in a process pool with this many processes
+        :param crf_window: size of the CRF windows, if None, the CRF runs on the whole tile
+        :param crf_window_overlap: #overlapping pixels between adjacent CRF windows
+        :param verbose: if True, print the time spent in each stage
+        :return:
+        """
+        if crf_params is None and densecrf:
+            crf_params = {'sxy': 3, 'srgb': 3, 'compat': 5}
+        model = self.prepare_model(model)
+        crf_pool = None
+        if densecrf and crf_workers > 0:
+            crf_pool = ProcessPoolExecutor(crf_workers)
+        timer = misc_utils.StageTimer()
 
+        misc_utils.make_dir_if_not_exist(pred_dir)
+        post_args = (pred_dir, ext, file_ext, densecrf, crf_params, save_conf, crf_window, crf_window_overlap,
+                     crf_pool, timer)
+        self.start_model_pool()
+        try:
+            if read_workers > 0 or post_workers > 0 or crf_pool is not None:
+                self.infer_pipeline(model, patch_size, overlap, post_args, visualize, read_workers,
+                                    max(post_workers, crf_workers), queue_size, timer)
+            else:
+                pbar = tqdm(self.rgb_files)
+                for rgb_file in pbar:
+                    with timer.time('read'):
+                        file_name, rgb = self.read_stage(rgb_file)
+                    pbar.set_description('Inferring {}'.format(file_name))
+                    with timer.time('model'):
+                        tile_preds = self.predict_tile(model, rgb, patch_size, overlap)
+                    pred_img = self.post_stage(tile_preds, rgb, file_name, *post_args)
+
+                    if visualize:
+                        vis_utils.compare_figures([self.read_tile(rgb), pred_img], (1, 2), fig_size=(12, 5))
+                    self.close_tile(rgb)
+        finally:
+            self.stop_model_pool()
+            if crf_pool is not None:
+                crf_pool.shutdown(wait=True)
+        tm.misc_utils.verb_print(timer.report(), verbose)
+
+    def infer_pipeline(self, model, patch_size, overlap, post_args, visualize=False, read_workers=1, post_workers=1,
+                       queue_size=2, timer=None):
+        """
+        Producer/consumer version of infer(), see infer() for the details
+        :param model: the model or a list of models to do the inference
+        :param patch_size: size of the patches
+        :param overlap: #overlapping pixels between patches
+        :param post_args: arguments of post_stage() after the file name
+        :param visualize: if True, the predictions will be displayed
+        :param read_workers: #threads to decode the tiles
+        :param post_workers: #threads to post process and write the predictions
+        :param queue_size: max #tiles waiting between two stages
+        :param timer: misc_utils.StageTimer to record the time spent
+        :return:
+        """
+        if timer is None:
+            timer = misc_utils.StageTimer()
+        read_pool = ThreadPoolExecutor(max(read_workers, 1))
+        post_pool = ThreadPoolExecutor(max(post_workers, 1))
+        read_queue = queue.Queue(maxsize=queue_size)
+        # set when the consumer stops, e.g. the model or the post stage raised, so the producer does not block forever
+        stop_event = threading.Event()
+
+        def read_stage(rgb_file):
+            with timer.time('read'):
+                return self.read_stage(rgb_file)
+
+        def put(item):
+            while not stop_event.is_set():
+                try:
+                    read_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            if item is not None:
+                item.cancel()
+            return False
+
+        def producer():
+            # put() blocks once queue_size tiles are waiting, so decoding never runs too far ahead
+            for rgb_file in self.rgb_files:
+                if stop_event.is_set() or not put(read_pool.submit(read_stage, rgb_file)):
+                    return
+            put(None)
+
+        def discard(read_future):
+            # drop a tile that will never reach the model, release its reader if it has been opened
+            if read_future.cancel() or read_future.exception() is not None:
+                return
+            self.close_tile(read_future.result()[1])
+
+        def finish(post_item):
+            rgb, post_future = post_item
+            with timer.time('post_wait'):
+                pred_img = post_future.result()
             if visualize:
-                vis_utils.compare_figures([rgb, pred_img], (1, 2), fig_size=(12, 5))
+                vis_utils.compare_figures([self.read_tile(rgb), pred_img], (1, 2), fig_size=(12, 5))
+            self.close_tile(rgb)
+            pbar.update(1)
+
+        pbar = tqdm(total=len(self.rgb_files), desc='Inferring')
+        threading.Thread(target=producer, daemon=True).start()
+        post_items = deque()
+        try:
+            while True:
+                with timer.time('read_wait'):
+                    read_future = read_queue.get()
+                    if read_future is None:
+                        break
+                    file_name, rgb = read_future.result()
+                with timer.time('model'):
+                    tile_preds = self.predict_tile(model, rgb, patch_size, overlap)
+                post_items.append((rgb, post_pool.submit(self.post_stage, tile_preds, rgb, file_name, *post_args)))
+                while len(post_items) > queue_size:
+                    finish(post_items.popleft())
+            while len(post_items) > 0:
+                finish(post_items.popleft())
+        finally:
+            pbar.close()
+            stop_event.set()
+            while True:
+                try:
+                    read_future = read_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if read_future is not None:
+                    discard(read_future)
+            for _, post_future in post_items:
+                post_future.cancel()
+            read_pool.shutdown(wait=False)
+            post_pool.shutdown(wait=True)
 
 
 class BaseEnsemble(object):
+    # if True, fuse_data() also works on torch tensors on the inference device
+    tensor_fuse = True
+    # if True, the ensembler augments and fuses the transformed batch on the device with predict()
+    on_tensor = False
+
     @staticmethod
     def augment_data(img):
         return [img, ]
@@ -595,6 +1121,8 @@ class BaseEnsemble(object):
 
 
 class MultiResEnsemble(BaseEnsemble):
+    tensor_fuse = False
+
     def __init__(self, aug_size, fuse_size=None, rotate=True, use_max=False):
         self.aug_size = aug_size
         self.rotate = rotate
@@ -646,6 +1174,73 @@ class MultiResEnsemble(BaseEnsemble):
         return np.expand_dims(data_utils.change_channel_order(pred, to_channel_last=False), axis=0)
 
 
+class TensorMultiResEnsemble(MultiResEnsemble):
+    """
+    Tensor version of MultiResEnsemble, all the flipped, rotated and rescaled copies of a patch batch are made on the
+    device in one shot, each scale runs as a single batched forward pass and the geometric transforms are inverted with
+    tensor ops before fusing
+    """
+    on_tensor = True
+
+    def augment_data(self, img):
+        """
+        The patches are not augmented on the cpu, predict() makes all the copies of the transformed batch on the device
+        :param img: h*w*3 patch
+        :return: list of the patch itself
+        """
+        return [img, ]
+
+    def augment_batch(self, data, aug_size):
+        """
+        Make the augmented copies of the batch at the given scale
+        :param data: n*c*h*w tensor
+        :param aug_size: size to rescale the batch to
+        :return: (copy_per_img*n)*c*aug_size*aug_size tensor, copies of the same transform are contiguous
+        """
+        if data.shape[2] != aug_size or data.shape[3] != aug_size:
+            data = F.interpolate(data, size=(aug_size, aug_size), mode='bilinear', align_corners=False)
+        aug_data = [data]
+        if self.rotate:
+            data_rot = torch.rot90(data, 1, (2, 3))
+            aug_data.extend([torch.flip(data, (2,)), torch.flip(data, (3,)), data_rot, torch.flip(data_rot, (2,)),
+                             torch.flip(data_rot, (3,))])
+        return torch.cat(aug_data, 0)
+
+    def fuse_batch(self, preds, n):
+        """
+        Invert the transforms of augment_batch() and average the copies
+        :param preds: (copy_per_img*n)*c*h*w tensor
+        :param n: #patches in the batch
+        :return: n*c*fuse_size*fuse_size tensor
+        """
+        preds = torch.split(preds, n, 0)
+        fuse_preds = [preds[0]]
+        if self.rotate:
+            fuse_preds.extend([torch.flip(preds[1], (2,)), torch.flip(preds[2], (3,)),
+                               torch.rot90(preds[3], -1, (2, 3)),
+                               torch.rot90(torch.flip(preds[4], (2,)), -1, (2, 3)),
+                               torch.rot90(torch.flip(preds[5], (3,)), -1, (2, 3))])
+        fuse_preds = torch.stack(fuse_preds, 0).mean(0)
+        if fuse_preds.shape[2] != self.fuse_size or fuse_preds.shape[3] != self.fuse_size:
+            fuse_preds = F.interpolate(fuse_preds, size=(self.fuse_size, self.fuse_size), mode='bilinear',
+                                       align_corners=False)
+        return fuse_preds
+
+    def predict(self, forward_func, data):
+        """
+        Run the test time augmentation on a batch
+        :param forward_func: function that maps a n*c*h*w batch to n*c*h*w softmax predictions
+        :param data: n*c*h*w tensor on the device
+        :return: n*c*fuse_size*fuse_size fused predictions
+        """
+        fuse_tps = torch.stack([self.fuse_batch(forward_func(self.augment_batch(data, aug_size)), data.shape[0])
+                                for aug_size in self.aug_size], 0)
+        if self.use_max:
+            return fuse_tps.max(0)[0]
+        else:
+            return fuse_tps.mean(0)
+
+
 if __name__ == '__main__':
     rgb_file = r'/media/ei-edl01/data/remote_sensing_data/inria/images/austin1.tif'
     lbl_file = r'/media/ei-edl01/data/remote_sensing_data/inria/gt/austin1.tif'
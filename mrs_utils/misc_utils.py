@@ -3,9 +3,12 @@ import os
 import time
 import json
 import pickle
+import hashlib
+import threading
 import collections.abc
 from glob import glob
 from functools import wraps
+from contextlib import contextmanager
 
 # Libs
 import torch
@@ -68,6 +71,52 @@ def timer_decorator(func):
     return timer_wrapper
 
 
+class StageTimer(object):
+    """
+    Accumulate the time spent in each named stage of a pipeline, stages could be timed from multiple threads
+    """
+    def __init__(self):
+        self.durations = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, name, duration):
+        """
+        Add the duration to the given stage
+        :param name: name of the stage
+        :param duration: #seconds spent
+        :return:
+        """
+        with self.lock:
+            self.durations[name] = self.durations.get(name, 0) + duration
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    @contextmanager
+    def time(self, name):
+        """
+        Time the code block inside the with statement as the given stage
+        :param name: name of the stage
+        :return:
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start_time)
+
+    def report(self):
+        """
+        Make the timing report
+        :return: report string with the total and per call time of each stage
+        """
+        report_str = 'Wall time: {:.3f}s\n'.format(time.time() - self.start_time)
+        for name, duration in self.durations.items():
+            report_str += '\t{}: {:.3f}s ({:.3f}s x {})\n'.format(name, duration, duration / self.counts[name],
+                                                                 self.counts[name])
+        return report_str
+
+
 def str2list(s, sep=',', d_type=int):
     """
     Change a {sep} separated string into a list of items with d_type
@@ -121,12 +170,13 @@ def load_file(file_name, **kwargs):
         raise IOError('Problem loading {}'.format(file_name))
 
 
-def save_file(file_name, data, fmt='%.8e', sort_keys=True, indent=4):
+def save_file(file_name, data, fmt='%.8e', sort_keys=True, indent=4, **kwargs):
     """
     Save data file of given path, use numpy.load if it is in .npy format,
     otherwise use pickle or imageio
     :param file_name: absolute path to the file
     :param data: data to save
+    :param kwargs: other parameters passed to PIL when saving images, e.g. quality of jpg or compress_level of png
     :return: file data, or IOError if it cannot be saved by either numpy or or pickle imageio
     """
     try:
@@ -143,12 +193,69 @@ def save_file(file_name, data, fmt='%.8e', sort_keys=True, indent=4):
         elif file_name[-4:] == 'json':
             json.dump(data, open(file_name, 'w'), sort_keys=sort_keys, indent=indent)
         else:
-            data = Image.fromarray(data.astype(np.uint8))
-            data.save(file_name)
+            data = Image.fromarray(data.astype(np.uint8, copy=False))
+            data.save(file_name, **kwargs)
     except Exception:  # so many things could go wrong, can't be more specific.
         raise IOError('Problem saving this data')
 
 
+def get_tile_signature(files, params):
+    """
+    Make a signature of a tile, the signature changes if any of the source files is modified or the parameters are
+    changed, this is used to decide whether a tile needs to be processed again
+    :param files: list of source files of the tile
+    :param params: list of parameters used to process the tile, they are stored by their repr()
+    :return: the signature as a dictionary
+    """
+    return {
+        'files': [[os.path.abspath(f), os.path.getsize(f), os.path.getmtime(f)] for f in files],
+        'params': [repr(a) for a in params]
+    }
+
+
+def get_manifest_file(manifest_dir, files):
+    """
+    Get the path to the manifest of a tile, the manifest is keyed by the absolute paths of the source files
+    :param manifest_dir: directory of the manifests
+    :param files: list of source files of the tile
+    :return: path to the manifest file
+    """
+    key = hashlib.md5('\n'.join([os.path.abspath(f) for f in files]).encode('utf-8')).hexdigest()
+    return os.path.join(manifest_dir, '{}.json'.format(key))
+
+
+def load_manifest(manifest_file, signature):
+    """
+    Load the records in the manifest of a tile if the tile has been processed with the same signature
+    :param manifest_file: path to the manifest file
+    :param signature: signature of the tile, made by get_tile_signature()
+    :return: the records, or None if the tile needs to be processed again
+    """
+    if not os.path.exists(manifest_file):
+        return None
+    try:
+        manifest = load_file(manifest_file)
+    except IOError:
+        return None
+    if manifest.get('signature') != signature:
+        return None
+    return manifest['records']
+
+
+def save_manifest(manifest_file, signature, records):
+    """
+    Save the manifest of a processed tile, the file is written to a temporary file first then renamed, so an
+    interrupted write never leaves a manifest that looks complete
+    :param manifest_file: path to the manifest file
+    :param signature: signature of the tile, made by get_tile_signature()
+    :param records: the records produced by the tile, e.g. lines in the file list
+    :return:
+    """
+    tmp_file = '{}.{}.tmp.json'.format(os.path.splitext(manifest_file)[0], os.getpid())
+    save_file(tmp_file, {'signature': signature, 'records': records})
+    os.replace(tmp_file, manifest_file)
+
+
 def get_img_channel_num(file_name):
     """
     Get #channels of the image file
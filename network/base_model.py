@@ -71,11 +71,11 @@ class Base(nn.Module):
 
     def step(self, data_loaders, device, optm, phase, criterions, bp_loss_idx=0, save_image=True,
              mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), loss_weights=None, use_emau=False,
-             use_ocr=False, cls_criterion=None, cls_weight=0.1):
+             use_ocr=False, cls_criterion=None, cls_weight=0.1, gpu_tsfm=None):
         """
         This function does one forward and backward path in the training
         Print necessary message
-        :param kwargs:
+        :param gpu_tsfm: if not None, the batch transform (see data.gpu_tsfm) applied on the device to the uint8 batch
         :return:
         """
         # settings
@@ -107,6 +107,9 @@ class Base(nn.Module):
                     for key, val in data_dict.items():
                         data_dict[key] = torch.cat([val, data_dict_other[key]], dim=0)
 
+            if gpu_tsfm is not None:
+                data_dict['image'], data_dict['mask'] = gpu_tsfm(data_dict['image'].to(device),
+                                                                 data_dict['mask'].to(device))
             image = Variable(data_dict['image'], requires_grad=True).to(device)
             label = Variable(data_dict['mask']).long().to(device)
             if aux_train:
@@ -5,13 +5,15 @@
 
 # Built-in
 import os
+import json
 
 # Libs
 import numpy as np
 
 # Pytorch
 import albumentations as A
-from torch import optim
+import torch
+from torch import nn, optim
 from albumentations.pytorch import ToTensorV2
 
 # Own modules
@@ -134,6 +136,32 @@ def create_tsfm(args, mean, std, normalize=True, tsfms=None):
     return tsfm_train, tsfm_valid
 
 
+def create_gpu_tsfm(args, mean, std, normalize=True):
+    """
+    Create the transforms that augment the whole batch on the GPU, this mirrors the default transforms of
+    create_tsfm(), the data loader only converts the uint8 patches into tensors
+    :param args: the argument parameters defined in config.py
+    :param mean: mean of the dataset
+    :param std: std of the dataset
+    :param normalize: if True, will normalize the dataset
+    :return: the train and validation transforms of the data loader and the train and validation batch transforms
+    """
+    from data import gpu_tsfm
+    input_size = eval(args['dataset']['input_size'])
+    crop_size = eval(args['dataset']['crop_size'])
+    if input_size[0] > crop_size[0] and input_size[1] > crop_size[1]:
+        crop_mode = 'crop'
+    elif input_size[0] < crop_size[0] or input_size[1] < crop_size[1]:
+        crop_mode = 'resized_crop'
+    else:
+        crop_mode = None
+    tsfm_loader = A.Compose([ToTensorV2()])
+    gpu_tsfm_train = gpu_tsfm.GPUTransform(mean, std, crop_size, crop_mode, normalize=normalize)
+    gpu_tsfm_valid = gpu_tsfm.GPUTransform(mean, std, crop_size, crop_mode, flip=False, rot90=False,
+                                           normalize=normalize)
+    return tsfm_loader, tsfm_loader, gpu_tsfm_train, gpu_tsfm_valid
+
+
 def get_dataset_stats(ds_name, img_dir, load_func=None, file_list=None,
                       mean_val=([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])):
     if ds_name == 'inria':
@@ -198,11 +226,32 @@ def load_config(model_dir):
     return misc_utils.historical_process_flag(args)
 
 
-def easy_load(model_dir, epoch=None):
+def set_inference_precision(model, half=False, channels_last=False):
+    """
+    Convert the model for reduced precision inference, batch norm layers are kept in float32 since their statistics
+    are prone to overflow in half precision
+    :param model: the model to be converted
+    :param half: if True, the weights will be converted to float16
+    :param channels_last: if True, the weights will be stored in the channels last memory format
+    :return: the converted model
+    """
+    if half:
+        model.half()
+        for m in model.modules():
+            if isinstance(m, torch.nn.modules.batchnorm._BatchNorm):
+                m.float()
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    return model
+
+
+def easy_load(model_dir, epoch=None, half=False, channels_last=False):
     """
     Initialize and define model based on their corresponding configuration file
     :param model_dir: directory of the saved model
     :param epoch: number of epoch to load
+    :param half: if True, the model will be converted to float16 for inference
+    :param channels_last: if True, the model will use the channels last memory format
     :return:
     """
     config = load_config(model_dir)
@@ -214,4 +263,93 @@ def easy_load(model_dir, epoch=None):
     pretrained_dir = os.path.join(model_dir, 'epoch-{}.pth.tar'.format(load_epoch-1))
     network_utils.load(model, pretrained_dir)
     print('Loaded model from {} @ epoch {}'.format(model_dir, load_epoch))
-    return model
+    return set_inference_precision(model, half, channels_last)
+
+
+class InferenceWrapper(nn.Module):
+    def __init__(self, model):
+        """
+        Wrap the model so that the forward only returns the pred head, the dictionary outputs (mu, region, aux) of the
+        models can not be traced
+        :param model: the model to be wrapped
+        """
+        super(InferenceWrapper, self).__init__()
+        self.model = model
+        self.lbl_margin = model.lbl_margin
+
+    def forward(self, x):
+        return self.model.inference(x)
+
+
+def export_model(model_dir, save_dir=None, epoch=None, input_size=(512, 512), onnx=True, opset_version=11):
+    """
+    Export the model trained by train.py into inference only artifacts, a TorchScript module (model.pt) and
+    optionally an ONNX graph (model.onnx), the lbl_margin and #classes are stored in export.json as well as in the
+    TorchScript file
+    :param model_dir: the directory to the model, this directory should be created by train.py
+    :param save_dir: directory to save the artifacts, if None, they will be saved in model_dir
+    :param epoch: number of epoch to load, if None, the last epoch will be loaded
+    :param input_size: size of the example input used by tracing
+    :param onnx: if True, the ONNX graph will be exported as well
+    :param opset_version: ONNX opset version
+    :return: path to the TorchScript file
+    """
+    if save_dir is None:
+        save_dir = model_dir
+    misc_utils.make_dir_if_not_exist(save_dir)
+    args = load_config(model_dir)
+    model = create_model(args)
+    if epoch:
+        args['trainer']['epochs'] = epoch
+    ckpt_dir = os.path.join(model_dir, 'epoch-{}.pth.tar'.format(args['trainer']['epochs']))
+    network_utils.load(model, ckpt_dir)
+    model = InferenceWrapper(model)
+    model.eval()
+
+    meta = {'lbl_margin': int(model.lbl_margin), 'class_num': int(args['dataset']['class_num']),
+            'ckpt_dir': ckpt_dir}
+    example = torch.rand(1, 3, input_size[0], input_size[1])
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    script_file = os.path.join(save_dir, 'model.pt')
+    torch.jit.save(traced, script_file, _extra_files={'export.json': json.dumps(meta)})
+    if onnx:
+        torch.onnx.export(model, example, os.path.join(save_dir, 'model.onnx'), input_names=['image'],
+                          output_names=['pred'], opset_version=opset_version,
+                          dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                                        'pred': {0: 'batch', 2: 'height', 3: 'width'}})
+    misc_utils.save_file(os.path.join(save_dir, 'export.json'), meta)
+    print('Exported model from {} to {}'.format(ckpt_dir, save_dir))
+    return script_file
+
+
+class ExportedModel(nn.Module):
+    def __init__(self, file_name, device='cpu'):
+        """
+        Load the artifact made by export_model(), it behaves like the models in this repo during inference: it has the
+        lbl_margin attribute and the inference() function
+        TorchScript files (.pt) are loaded with torch.jit, ONNX files (.onnx) are run with onnxruntime
+        :param file_name: path to the model.pt or model.onnx file
+        :param device: the device to run the TorchScript module
+        """
+        super(ExportedModel, self).__init__()
+        self.session = None
+        if os.path.splitext(file_name)[1].lower() == '.onnx':
+            import onnxruntime
+            meta = misc_utils.load_file(os.path.join(os.path.dirname(file_name), 'export.json'))
+            self.session = onnxruntime.InferenceSession(file_name, providers=onnxruntime.get_available_providers())
+        else:
+            extra_files = {'export.json': ''}
+            self.model = torch.jit.load(file_name, map_location=device, _extra_files=extra_files)
+            meta = json.loads(extra_files['export.json'])
+        self.lbl_margin = meta['lbl_margin']
+        self.n_class = meta['class_num']
+
+    def forward(self, x):
+        if self.session is not None:
+            pred = self.session.run(['pred'], {'image': x.float().cpu().numpy()})[0]
+            return torch.from_numpy(pred).to(x.device)
+        return self.model(x)
+
+    def inference(self, x):
+        return self.forward(x)
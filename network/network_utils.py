@@ -336,3 +336,69 @@ def infi_loop_loader(dl):
     """
     while True:
         for x in dl: yield x
+
+
+class DataPrefetcher(object):
+    def __init__(self, loader, device):
+        """
+        Wrap a data loader so the next batch is copied to the device on a separate CUDA stream while the current batch
+        is being computed, the batches should be dictionaries of tensors, the tensors are pinned if the loader doesn't
+        pin them already
+        The time the loop waited on the loader is accumulated in wait_time, call reset_wait_time() at the start of every
+        epoch, it is not reset by __iter__() since infi_loop_loader() restarts the smaller loaders within an epoch
+        On other devices the batches are yielded as they are, only the wait time is recorded
+        :param loader: the data loader
+        :param device: the device to copy the batches to
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+        self.wait_time = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def reset_wait_time(self):
+        self.wait_time = 0
+
+    def next_batch(self, iterator):
+        start_time = timeit.default_timer()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        finally:
+            self.wait_time += timeit.default_timer() - start_time
+        return batch
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        if self.device.type != 'cuda':
+            batch = self.next_batch(iterator)
+            while batch is not None:
+                yield batch
+                batch = self.next_batch(iterator)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        batch = self.preload(iterator, stream)
+        while batch is not None:
+            # the compute stream waits for the copies of this batch, the copies of the next batch run behind it
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            for val in batch.values():
+                if torch.is_tensor(val):
+                    val.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self.preload(iterator, stream)
+            yield batch
+            batch = next_batch
+
+    def preload(self, iterator, stream):
+        batch = self.next_batch(iterator)
+        if batch is None:
+            return None
+        with torch.cuda.stream(stream):
+            for key, val in batch.items():
+                if torch.is_tensor(val):
+                    if not val.is_pinned():
+                        val = val.pin_memory()
+                    batch[key] = val.to(self.device, non_blocking=True)
+        return batch
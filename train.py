@@ -16,7 +16,7 @@ from tensorboardX import SummaryWriter
 # Pytorch
 import torch
 from torch import optim
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset
 
 # Own modules
 from data import data_loader, data_utils
@@ -38,6 +38,70 @@ def read_config():
     return flags
 
 
+def get_tile_kwargs(ds_args, random_sample):
+    """
+    Get the parameters of data_loader.TileDataLoader from the dataset configuration, the train and valid files should
+    list the source tiles instead of the patches
+    :param ds_args: the dataset configuration
+    :param random_sample: if True, patches are sampled at random locations, this should be False for validation
+    :return: dictionary of the parameters
+    """
+    decode_func = None
+    if ds_args.get('decode_label', False):
+        import importlib
+        decode_func = importlib.import_module('data.{}.preprocess'.format(ds_args['ds_name'])).decode_map
+    return {
+        'patch_size': eval(ds_args['input_size']),
+        'samples_per_tile': ds_args.get('samples_per_tile', None),
+        'pad': int(ds_args.get('tile_pad', 0)),
+        'random_sample': random_sample,
+        'truth_val': int(ds_args.get('truth_val', 1)),
+        'decode_func': decode_func,
+        'max_readers': int(ds_args.get('tile_max_readers', 4)),
+    }
+
+
+def get_fg_sampler(ds_args, dataset):
+    """
+    Get the foreground balanced sampler of the training set, the foreground fractions of the patches are read from
+    the foreground index beside the file list
+    :param ds_args: the dataset configuration, fg_ratio is the #positive and #negative patches in each batch and fg_th
+                    is the foreground fraction above which a patch is positive
+    :param dataset: the training set, should be a data_loader.RSDataLoader
+    :return: the sampler
+    """
+    assert not ds_args.get('tile_sample', False), 'fg_ratio does not support tile_sample'
+    assert isinstance(dataset, data_loader.RSDataLoader), \
+        'fg_ratio only supports the patch lists read by RSDataLoader, got {}'.format(ds_args['train_file'])
+    ratio = eval(ds_args['fg_ratio'])
+    assert sum(ratio) == int(ds_args['batch_size']), 'fg_ratio should add up to the batch size'
+    index_file = None
+    if ds_args['train_file'][-3:] == 'txt':
+        index_file = data_loader.get_fg_index_file(ds_args['train_file'])
+    fg_fractions = data_loader.get_fg_fractions(dataset.lbl_list, index_file, int(ds_args.get('num_workers', 0)))
+    return data_loader.ForegroundBalancedSampler(fg_fractions, ratio, float(ds_args.get('fg_th', 0)))
+
+
+def get_hdf5_loader(ds_args, file_name, transforms, with_aux, num_workers, shuffle):
+    """
+    Get the batch-level loader of a hdf5 dataset, each batch is read with one sorted read per dataset and the
+    shuffling is done at the granularity of the hdf5 chunks
+    :param ds_args: the dataset configuration, hdf5_mix_chunks is the #chunks whose samples are mixed together
+    :param file_name: name of the hdf5 file
+    :param transforms: albumentation transforms
+    :param with_aux: if True, auxiliary classification label will be returned
+    :param num_workers: #workers of the loader
+    :param shuffle: if True, the batches are shuffled and the last incomplete batch is dropped
+    :return: the data loader
+    """
+    dataset = data_loader.HDF5BatchDataLoader(ds_args['data_dir'], file_name, transforms=transforms,
+                                              n_class=ds_args['class_num'], with_aux=with_aux)
+    sampler = data_loader.ChunkShuffleBatchSampler(len(dataset), int(ds_args['batch_size']), dataset.chunk_size,
+                                                   int(ds_args.get('hdf5_mix_chunks', 4)), shuffle=shuffle,
+                                                   drop_last=shuffle)
+    return DataLoader(dataset, batch_size=None, sampler=sampler, num_workers=num_workers, pin_memory=True)
+
+
 def train_model(args, device, parallel):
     """
     The function to train the model
@@ -94,6 +158,10 @@ def train_model(args, device, parallel):
     ds_cfgs = [a for a in sorted(args.keys()) if 'dataset' in a]
     assert ds_cfgs[0] == 'dataset'
     mean, std = args[ds_cfgs[0]]['mean'], args[ds_cfgs[0]]['std'] # read default mean and std first
+    # the batch transforms normalize with the stats of one dataset, they can't be shared by several loaders
+    assert not args.get('gpu_tsfm', False) or len(ds_cfgs) == 1, 'gpu_tsfm only supports a single dataset'
+    # the aux labels are made by the workers from the masks before the batch transforms crop them
+    assert not args.get('gpu_tsfm', False) or not with_aux, 'gpu_tsfm does not support the auxiliary loss'
 
     train_val_loaders = {'train': [], 'valid': []}
     for ds_cfg in ds_cfgs:
@@ -107,21 +175,59 @@ def train_model(args, device, parallel):
                                                  load_func=load_func, file_list=args[ds_cfg]['train_file'])
         args[ds_cfg]['mean'], args[ds_cfg]['std'] = str(tuple(mean)), str(tuple(std)) # update args mean and std with actual values being used
         
-        tsfm_train, tsfm_valid = network_io.create_tsfm(args, mean, std)
-        train_loader = DataLoader(data_loader.get_loader(
-            args[ds_cfg]['data_dir'], args[ds_cfg]['train_file'], transforms=tsfm_train,
-            n_class=args[ds_cfg]['class_num'], with_aux=with_aux),
-            batch_size=int(args[ds_cfg]['batch_size']), shuffle=True, num_workers=int(args['dataset']['num_workers']),
-            drop_last=True)
-        train_val_loaders['train'].append(train_loader)
+        gpu_tsfms = {'train': None, 'valid': None}
+        if args.get('gpu_tsfm', False):
+            # the workers only decode the patches, the augmentation is done on the whole batch on the device
+            tsfm_train, tsfm_valid, gpu_tsfms['train'], gpu_tsfms['valid'] = \
+                network_io.create_gpu_tsfm(args, mean, std)
+        else:
+            tsfm_train, tsfm_valid = network_io.create_tsfm(args, mean, std)
+        # sample patches from the source tiles on the fly instead of reading pre-cut patches
+        tile_kwargs_train, tile_kwargs_valid = None, None
+        if args[ds_cfg].get('tile_sample', False):
+            tile_kwargs_train = get_tile_kwargs(args[ds_cfg], True)
+            tile_kwargs_valid = get_tile_kwargs(args[ds_cfg], False)
+        # keep the decoded patches in shared memory, the budget is per loader in GB, the train and the valid loaders
+        # get one budget each, so up to twice of cache_gb is used
+        cache_bytes = int(float(args[ds_cfg].get('cache_gb', 0)) * 1024 ** 3)
+        if args[ds_cfg]['train_file'][-4:] == 'hdf5':
+            # read whole batches from the hdf5 stores, see data_utils.pack_tiles()
+            if args[ds_cfg].get('fg_ratio', False) or args[ds_cfg].get('tile_sample', False):
+                raise NotImplementedError('fg_ratio and tile_sample are not supported by hdf5 datasets')
+            train_loader = get_hdf5_loader(args[ds_cfg], args[ds_cfg]['train_file'], tsfm_train, with_aux,
+                                           int(args['dataset']['num_workers']), shuffle=True)
+        else:
+            train_ds = data_loader.get_loader(
+                args[ds_cfg]['data_dir'], args[ds_cfg]['train_file'], transforms=tsfm_train,
+                n_class=args[ds_cfg]['class_num'], with_aux=with_aux, tile_kwargs=tile_kwargs_train,
+                cache_bytes=cache_bytes)
+            if args[ds_cfg].get('fg_ratio', False):
+                # draw a fixed #positive and #negative patches in every batch
+                train_sampler = get_fg_sampler(args[ds_cfg], train_ds)
+                train_loader = DataLoader(train_ds, batch_size=int(args[ds_cfg]['batch_size']), sampler=train_sampler,
+                                          num_workers=int(args['dataset']['num_workers']), drop_last=True,
+                                          pin_memory=True)
+            else:
+                # iterable datasets (the tar shards) shuffle by themselves, the DataLoader can't shuffle them
+                train_loader = DataLoader(train_ds, batch_size=int(args[ds_cfg]['batch_size']),
+                                          shuffle=not isinstance(train_ds, IterableDataset),
+                                          num_workers=int(args['dataset']['num_workers']), drop_last=True,
+                                          pin_memory=True)
+        train_val_loaders['train'].append(network_utils.DataPrefetcher(train_loader, device))
 
         if 'valid_file' in args[ds_cfg]:
-            valid_loader = DataLoader (data_loader.get_loader(
-                args[ds_cfg]['data_dir'], args[ds_cfg]['valid_file'], transforms=tsfm_valid,
-                n_class=args[ds_cfg]['class_num'], with_aux=with_aux),
-                batch_size=int(args[ds_cfg]['batch_size']), shuffle=False, num_workers=int(args[ds_cfg]['num_workers']))
+            if args[ds_cfg]['valid_file'][-4:] == 'hdf5':
+                valid_loader = get_hdf5_loader(args[ds_cfg], args[ds_cfg]['valid_file'], tsfm_valid, with_aux,
+                                               int(args[ds_cfg]['num_workers']), shuffle=False)
+            else:
+                valid_loader = DataLoader (data_loader.get_loader(
+                    args[ds_cfg]['data_dir'], args[ds_cfg]['valid_file'], transforms=tsfm_valid,
+                    n_class=args[ds_cfg]['class_num'], with_aux=with_aux, tile_kwargs=tile_kwargs_valid,
+                    cache_bytes=cache_bytes, shuffle=False),
+                    batch_size=int(args[ds_cfg]['batch_size']), shuffle=False,
+                    num_workers=int(args[ds_cfg]['num_workers']), pin_memory=True)
             print('Training model on the {} dataset'.format(args[ds_cfg]['ds_name']))
-            train_val_loaders['valid'].append(valid_loader)
+            train_val_loaders['valid'].append(network_utils.DataPrefetcher(valid_loader, device))
     misc_utils.save_file(os.path.join(args['save_dir'], 'config.json'), args) # save config with actual mean and std used
 
     # train the model
@@ -134,13 +240,23 @@ def train_model(args, device, parallel):
                 model.train()
             else:
                 model.eval()
+            for dl in train_val_loaders[phase]:
+                dl.reset_wait_time()
+                # reshuffle the order of the tar shards
+                if hasattr(dl.loader.dataset, 'set_epoch'):
+                    dl.loader.dataset.set_epoch(epoch)
+                # the workers batch their own shards, so the #batches depends on the split of this epoch
+                if hasattr(dl.loader.dataset, 'set_batching'):
+                    dl.loader.dataset.set_batching(dl.loader.batch_size, dl.loader.num_workers, dl.loader.drop_last)
 
             # TODO align aux loss and normal train
             loss_dict = model.step(train_val_loaders[phase], device, optm, phase, criterions,
                                    eval(args['trainer']['bp_loss_idx']), True, mean, std,
                                    loss_weights=eval(args['trainer']['loss_weights']), use_emau=args['use_emau'],
                                    use_ocr=args['use_ocr'], cls_criterion=cls_criterion,
-                                   cls_weight=args['optimizer']['aux_loss_weight'])
+                                   cls_weight=args['optimizer']['aux_loss_weight'], gpu_tsfm=gpu_tsfms[phase])
+            # seconds the loop waited on the data loaders in this epoch
+            loss_dict['data_wait'] = sum([dl.wait_time for dl in train_val_loaders[phase]])
             network_utils.write_and_print(writer, phase, epoch, int(args['trainer']['epochs']), loss_dict, start_time)
 
         scheduler.step()